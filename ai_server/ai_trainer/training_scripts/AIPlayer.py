@@ -3,23 +3,31 @@
 from __future__ import print_function, division
 import itertools, time, copy
 import collections, random
-import os, pickle
+import os, sys, pickle
+import atexit, hashlib
+from multiprocessing import shared_memory, resource_tracker
 import numba
 from numba import cuda
 import numpy as np
 
+from bitboard import Bitboard
+
 board_size = 15
 show_q = False
 
 class AIPlayer:
-    def __init__(self, name, model=None, level=0):
+    def __init__(self, name, model=None, level=0, symmetric_cache=True, shared_cache=None, cache_bytes=None):
         self.name = name
         self.load_model(model)
         self.level = level
+        self.shared_cache = shared_cache # if set, the name of a cache in shared memory used by all processes opening it with the same model
+        self.cache_bytes = cache_bytes # memory budget of the cache in bytes, 2M entries if None
         self.learndata = dict()
         self.opponent = None
+        self.n_symmetries = SYMMETRIES if symmetric_cache else 1 # share cache between rotated / flipped positions
         self.all_interest_states = np.zeros(board_size**4 * 3, dtype=np.float32).reshape(board_size**2, 3, board_size, board_size)
         self.move_interest_values = np.zeros(board_size**2, dtype=np.float32).reshape(board_size,board_size)
+        self.bitboard = Bitboard() # line bitmasks for the game ending checks, follows the moves of the search
         self.reset()
         self.reset_cache()
 
@@ -42,8 +50,40 @@ class AIPlayer:
         self.started_from_beginning = True
 
     def reset_cache(self):
-        """ Reset cache before using new model """
-        self.cache = LeveledCache(maxlevel=self.level, maxsize=2000000)
+        """
+        Reset cache before using new model, the proven wins and losses are kept
+        A cache shared by name is tagged with the model weights, a new model moves to the block of its own tag
+        Nothing changes if the cache holds the values of these weights already, e.g. reset by the opponent sharing it
+        """
+        digest = model_digest(self.model)
+        shared_name = None if self.shared_cache is None else f"{self.shared_cache}_{digest}"
+        cache = getattr(self, 'cache', None)
+        if cache is not None and cache.maxlevel == self.level and (shared_name is None or cache.name == shared_name):
+            if cache.digest != digest:
+                # the values of the old model are not used anymore, by all processes sharing the cache
+                cache.new_model()
+        elif shared_name is not None:
+            if cache is not None and cache.name != shared_name:
+                # the block of the old model
+                self.close_cache()
+            self.cache = SharedArrayCache(shared_name, maxlevel=self.level, maxsize=2000000, max_bytes=self.cache_bytes)
+        else:
+            # fixed size table, 2M entries in 32MB
+            self.cache = ArrayCache(maxlevel=self.level, maxsize=2000000, max_bytes=self.cache_bytes)
+        self.cache.digest = digest
+
+    def close_cache(self):
+        """ Release the cache, a block of shared memory created by this player is removed """
+        cache = getattr(self, 'cache', None)
+        if cache is not None and hasattr(cache, 'close'):
+            cache.close()
+        self.cache = None
+
+    def share_cache(self, player):
+        """ Search with the cache of player, e.g. the opponent in self-play, releasing the own one """
+        if self.cache is not player.cache:
+            self.close_cache()
+            self.cache = player.cache
 
     def strategy(self, board_state, starting_level=0):
         """ AI's strategy 
@@ -75,14 +115,16 @@ class AIPlayer:
         empty_spots_left = board_size**2 - len(board[0]) - len(board[1])
         # predict next best action and q
         player = -1 if self.playing_white else 1
+        # the entries of the last moves get older
+        self.cache.new_search()
         # TODO: remove .copy()
-        best_move, best_q = self.best_action_q(state.copy(), empty_spots_left, alpha, beta, player, level=starting_level)
+        best_move, best_q = self.best_action_q(state.copy(), empty_spots_left, alpha, beta, player, level=starting_level, state_hashes=zobrist_hashes(state))
         # save the winrate and the state
         self.update_if_game_finish(state, best_move, best_q, player)
         # return the best move
         return (best_move[0]+1, best_move[1]+1), best_q
 
-    def best_action_q(self, state, empty_spots_left, alpha, beta, player, level=0):
+    def best_action_q(self, state, empty_spots_left, alpha, beta, player, level=0, state_hashes=None):
         """ 
         Get the optimal action for a state and the predicted win rate for player
 
@@ -98,6 +140,10 @@ class AIPlayer:
             Current beta value in alpha-beta pruning, the running max of the min win rate
         player: int
             The current player. 1 is black, -1 is white
+        level: int
+            Current level of the search, evaluate with the dnn model when self.level is reached
+        state_hashes: np.ndarray or None
+            Zobrist hashes of state for all symmetries, computed from state if not provided
 
         Returns
         -------
@@ -106,8 +152,22 @@ class AIPlayer:
         best_q: float or None
             The value the best move. 1.0 means 100% win, -1.0 means 100% lose, 0 means draw
         """
+        best_move, best_q, _ = self.best_action_search(state, empty_spots_left, alpha, beta, player, level, state_hashes)
+        return best_move, best_q
+
+    def best_action_search(self, state, empty_spots_left, alpha, beta, player, level=0, state_hashes=None, synced=False):
+        """
+        Same as best_action_q, but return (best_move, best_q, proven)
+        proven is True if best_q does not depend on the dnn model: it is a proven win, or all the values
+        it came from were proven by the ends of the game
+        synced is True inside the search, the bitboard has followed its moves already
+        """
         if empty_spots_left == 0: # Board filled up, it's a tie
-            return (0,0), 0.0
+            return (0,0), 0.0, True
+        if state_hashes is None:
+            state_hashes = zobrist_hashes(state)
+        if not synced:
+            self.bitboard.sync(state)
         verbose = False
         n_moves = 40 if empty_spots_left > 200 else 20
         self.move_interest_values.fill(0) # reuse the same array to save init cost
@@ -118,21 +178,26 @@ class AIPlayer:
         # if there is only one move to place, directly return that move, use same level
         if len(interested_moves) == 1:
             # check if this move is known
-            move, move_q, unknown_moves, unknown_move_ids = self.check_known(state, interested_moves, player, level)
+            move, move_q, proven, unknown_moves, unknown_move_ids = self.check_known(state, state_hashes, interested_moves, player, level, alpha, beta)
             if move != None:
                 best_q = move_q
             else:
-                best_q = self.next_iter_winrate(state, empty_spots_left, best_move, alpha, beta, player, level)
-            return best_move, best_q
+                best_q, proven = self.next_iter_winrate(state, empty_spots_left, best_move, alpha, beta, player, level, state_hashes)
+                self.cache.set(unknown_move_ids[0], best_q, level, search_bound(best_q, alpha, beta), proven)
+            return best_move, best_q, proven
         # if there are multiple moves to evaluate, check cache first
-        best_move, max_q, unknown_moves, unknown_move_ids = self.check_known(state, interested_moves, player, level)
+        best_move, max_q, proven, unknown_moves, unknown_move_ids = self.check_known(state, state_hashes, interested_moves, player, level, alpha, beta)
+        if max_q >= beta:
+            # fail-soft cutoff, a known move is already too good for the opponent to allow
+            return best_move, max_q, proven
         if len(unknown_moves) > 0:
             # for unknown moves, if level has reached, evaluate with DNN model
             if level >= self.level:
+                proven = False
                 dnn_q_array = self.dnn_evaluate(state, unknown_moves, player)
                 # store the values in cache
                 for move_id, dnn_q in zip(unknown_move_ids, dnn_q_array):
-                    self.cache.set(move_id, dnn_q, level)
+                    self.cache.set(move_id, dnn_q, level, proven=False)
                 # find the best move from tf results
                 dnn_best_move_idx = np.argmax(dnn_q_array)
                 dnn_max_q = dnn_q_array[dnn_best_move_idx]
@@ -142,109 +207,113 @@ class AIPlayer:
                     best_move = unknown_moves[dnn_best_move_idx]
             else:
                 # if level has not reached yet, go deeper to the next level
+                alpha = max(alpha, max_q)
                 for move, move_id in zip(unknown_moves, unknown_move_ids):
-                    q = self.next_iter_winrate(state, empty_spots_left, move, alpha, beta, player, level+1)
-                    # store the result in cache
-                    self.cache.set(move_id, q, level+1)
+                    q, q_proven = self.next_iter_winrate(state, empty_spots_left, move, alpha, beta, player, level+1, state_hashes)
+                    # store the result in cache, it is only a bound if it fell outside of the window
+                    self.cache.set(move_id, q, level+1, search_bound(q, alpha, beta), q_proven)
+                    proven = proven and q_proven
                     if q > max_q:
                         max_q = q
                         best_move = move
-                    if max_q >= 1.0:
-                        # early return
+                        alpha = max(alpha, max_q)
+                        if q >= 1.0:
+                            # a proven win is enough, whatever the other moves are worth
+                            proven = q_proven
+                    if max_q >= 1.0 or alpha >= beta:
+                        # early return, found a win or a beta cutoff
                         break
-        return best_move, max_q
+        return best_move, max_q, proven
 
-    def next_iter_winrate(self, state, empty_spots_left, current_move, alpha, beta, player, level):
-        """Execute the step of the player, then return the winrate by computing next step"""
-        # update the stone down
+    def next_iter_winrate(self, state, empty_spots_left, current_move, alpha, beta, player, level, state_hashes):
+        """Execute the step of the player, then return the winrate by computing next step, and if it is proven"""
+        # update the stone down, and its hashes
         state[current_move] = player
+        self.bitboard.place(current_move[0], current_move[1], player)
+        state_hashes = update_hashes(state_hashes, current_move[0], current_move[1], player, zobrist_table)
         # known moves were handled already, here we evaluate opponents winrate
-        opponent_best_move, opponent_best_q = self.best_action_q(state, empty_spots_left-1, alpha, beta, -player, level)
+        # the search window is flipped and negated for the opponent (negamax)
+        opponent_best_move, opponent_best_q, proven = self.best_action_search(state, empty_spots_left-1, -beta, -alpha, -player, level, state_hashes, synced=True)
         # recover state
         state[current_move] = 0
+        self.bitboard.remove(current_move[0], current_move[1])
         # my winrate is opposite of opponents
-        return -opponent_best_q
+        return -opponent_best_q, proven
 
-    def check_known(self, state, interested_moves, player, level):
+    def check_known(self, state, state_hashes, interested_moves, player, level, alpha=-2.0, beta=2.0):
         """
         Check which move in interested moves is known, using cache and ending condition
         When find_interested_moves only return 1 move, it might be a forced move (win or lose),
-        In this case, we will check ending condition i_win, i_lost or i_will_win
+        In this case, we will check the ending conditions with the bitboard: i win, i lost or i will win
+        Cached bounds are only used if they are decisive for the (alpha, beta) window
 
-        return (best_move, max_q, unknown_moves, unknown_move_ids)
+        return (best_move, max_q, proven, unknown_moves, unknown_move_ids)
         best_move, max_q are the best of the known moves among the interested_moves
+        proven is True if max_q is a proven win or all the known values are proven, see ArrayCache.get_entry
         unknown_moves, unknown_move_ids are for remaining unknown moves among the interested_moves
+        move ids are the canonical zobrist keys of the state after each move, updated from state_hashes
         """
         max_q = -100
         best_move = None
+        proven = True
         unknown_moves = []
         unknown_move_ids = []
+        move_ids = key_list(canonical_move_keys(state_hashes, interested_moves, player, self.n_symmetries, zobrist_table))
         if len(interested_moves) == 1:
             this_move = (interested_moves[0][0], interested_moves[0][1])
             assert state[this_move] == 0 # interest move should be empty here
             # put down this move
             state[this_move] = player
-            # check game ending conditions
-            # 1. i win (highest priority)
-            if i_win(state, this_move, player):
+            self.bitboard.place(this_move[0], this_move[1], player)
+            # check game ending conditions: i win, i lost (only if I don't win) or i will win next round
+            result = self.bitboard.move_result(this_move[0], this_move[1], player)
+            if result != 0:
                 best_move = this_move
-                max_q = 1.0
-            # 2. I lost, acccurate only if I don't win
-            elif i_lost(state, player):
-                best_move = this_move
-                max_q = -1.0
-            # 3. I will win next round, only if I don't lose this round
-            elif i_will_win(state, this_move, player):
-                best_move = this_move
-                max_q = 1.0
+                max_q = float(result)
             else:
                 # check if this state is cached
-                this_state_id = state.tobytes()
-                q = self.cache.get(this_state_id, level)
-                if q is not None:
+                this_state_id = move_ids[0]
+                entry = self.cache.get_entry(this_state_id, level, alpha, beta)
+                if entry is not None:
                     best_move = this_move
-                    max_q = q
+                    max_q, proven = entry
                 else:
                     # q is not known for this move
                     unknown_moves.append(this_move)
                     unknown_move_ids.append(this_state_id)
             # restore state 
             state[this_move] = 0
+            self.bitboard.remove(this_move[0], this_move[1])
             # early return
-            return best_move, max_q, unknown_moves, unknown_move_ids
+            return best_move, max_q, proven, unknown_moves, unknown_move_ids
         # if reached here, means there are more than one interested moves
         # it means none of the moves are game-ending moves
-        for move in interested_moves:
+        for move, this_state_id in zip(interested_moves, move_ids):
             this_move = (move[0], move[1])
             assert state[this_move] == 0 # interest move should be empty here
-            # put down this move
-            state[this_move] = player
-            # compute cache key
-            this_state_id = state.tobytes()
             # check if its cached
-            q = self.cache.get(this_state_id, level)
-            if q is not None:
+            entry = self.cache.get_entry(this_state_id, level, alpha, beta)
+            if entry is not None:
+                q, q_proven = entry
                 # early return when found winning move
                 if q == 1.0:
-                    # restore state 
-                    state[this_move] = 0
                     # early return
                     best_move = this_move
                     max_q = 1.0
+                    proven = q_proven
                     unknown_moves = []
                     unknown_move_ids = []
                     break
+                proven = proven and q_proven
                 # compare with running max, update
-                elif q > max_q:
+                if q > max_q:
                     max_q = q
                     best_move = this_move
             else:
                 # q is not known
                 unknown_moves.append(this_move)
                 unknown_move_ids.append(this_state_id)
-            # restore state 
-            state[this_move] = 0
-        return best_move, max_q, unknown_moves, unknown_move_ids
+        return best_move, max_q, proven, unknown_moves, unknown_move_ids
 
     
     def dnn_evaluate(self, state, dnn_moves, player):
@@ -270,7 +339,7 @@ class AIPlayer:
         # state[best_move] = 0
 
         # store learn data for oppoenent, this helps improve the data
-        state_id = state.tobytes()
+        state_id = canonical_key(zobrist_hashes(state), 1) # keep symmetric positions apart in training data
         # if self.playing_white == False and best_q == -1.0:
             # import IPython; IPython.embed()
 
@@ -327,6 +396,76 @@ class AIPlayer:
 
 # Below are utility functions
 
+# Zobrist hashing: a random key for each (player, position), the hash of a state is the xor of the keys of all stones
+# so it can be updated incrementally when a stone is placed or removed.
+# The hashes of all 8 symmetric images of the board (rotations and flips) are updated together,
+# the smallest one is the canonical key, so symmetric positions share the same cache entry.
+SYMMETRIES = 8
+
+def symmetric_position(r, c, sym):
+    """ Position of (r, c) after transforming the board with one of the 8 symmetries, 0 is identity """
+    n = board_size - 1
+    return ((r, c), (c, n-r), (n-r, n-c), (n-c, r), (r, n-c), (n-r, c), (c, r), (n-c, n-r))[sym]
+
+def build_zobrist_table(seed=15):
+    """
+    Build the zobrist keys indexed by [player, r, c, symmetry]
+    Players are indexed directly, 1 for black and -1 for white, 0 (empty) has no key
+    zobrist_table[p, r, c, s] is the key of a stone of player p at (r, c) on the board transformed by symmetry s
+    """
+    rng = np.random.default_rng(seed) # fixed seed so hashes are the same in every process
+    keys = np.zeros((3, board_size, board_size), dtype=np.uint64)
+    keys[1:] = rng.integers(0, 2**64, size=(2, board_size, board_size), dtype=np.uint64)
+    table = np.zeros((3, board_size, board_size, SYMMETRIES), dtype=np.uint64)
+    for sym in range(SYMMETRIES):
+        for r in range(board_size):
+            for c in range(board_size):
+                sr, sc = symmetric_position(r, c, sym)
+                table[:, r, c, sym] = keys[:, sr, sc]
+    return table
+
+zobrist_table = build_zobrist_table()
+
+def zobrist_hashes(state):
+    """ Compute the zobrist hashes of all symmetries of a state from scratch, shape (SYMMETRIES,) """
+    hashes = np.zeros(SYMMETRIES, dtype=np.uint64)
+    for r, c in zip(*np.nonzero(state)):
+        hashes ^= zobrist_table[state[r, c], r, c]
+    return hashes
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def update_hashes(hashes, r, c, player, zobrist_table):
+    """ Return the new hashes after a stone of player is placed (or removed) at (r, c) """
+    new_hashes = hashes.copy()
+    for sym in range(SYMMETRIES):
+        new_hashes[sym] ^= zobrist_table[player, r, c, sym]
+    return new_hashes
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def canonical_move_keys(hashes, moves, player, n_symmetries, zobrist_table):
+    """
+    Compute the canonical key of the state after each move, without placing the stones
+    The canonical key is the smallest hash among the first n_symmetries symmetries
+    """
+    n = len(moves)
+    keys = np.empty(n, dtype=np.uint64)
+    for i in range(n):
+        r = moves[i, 0]
+        c = moves[i, 1]
+        for sym in range(n_symmetries):
+            h = hashes[sym] ^ zobrist_table[player, r, c, sym]
+            if sym == 0 or h < keys[i]:
+                keys[i] = h
+    return keys
+
+def canonical_key(hashes, n_symmetries=SYMMETRIES):
+    """ Key of a state from its hashes, the smallest hash among the first n_symmetries symmetries """
+    return int(hashes[:n_symmetries].min())
+
+def key_list(keys):
+    """ Convert the keys from canonical_move_keys to python ints used by the cache """
+    return keys.tolist()
+
 @numba.jit(nopython=True, nogil=True, cache=True)
 def find_interesting_moves(state, empty_spots_left, move_interest_values, player, n_moves, verbose=False):
     """ Look at state and find the interesing n_move moves.
@@ -385,7 +524,9 @@ def find_interesting_moves(state, empty_spots_left, move_interest_values, player
                     elif skipped_1 == 0:
                         skipped_1 = i + 1 # allow one skip and record the position of the skip
                     else:
-                        # peek at the next one and if it might be useful, add some interest
+                        # peek at the next one (if still on board) and if it might be useful, add some interest
+                        if ext_r+dr < 0 or ext_r+dr >= board_size or ext_c+dc < 0 or ext_c+dc >= board_size:
+                            break
                         if ((state[ext_r+dr, ext_c+dc] == player) and (my_blocked == False)) or ((state[ext_r+dr, ext_c+dc] == -player) and (opponent_blocked == False)):
                             interest_value += 15
                         break
@@ -432,7 +573,9 @@ def find_interesting_moves(state, empty_spots_left, move_interest_values, player
                         if skipped_2 == 0:
                             skipped_2 = i + 1
                         else:
-                            # peek at the next one and if it might be useful, add some interest
+                            # peek at the next one (if still on board) and if it might be useful, add some interest
+                            if ext_r-dr < 0 or ext_r-dr >= board_size or ext_c-dc < 0 or ext_c-dc >= board_size:
+                                break
                             if state[ext_r-dr, ext_c-dc] == player:
                                 interest_value += 15
                             break
@@ -476,7 +619,9 @@ def find_interesting_moves(state, empty_spots_left, move_interest_values, player
                             if skipped_2 == 0:
                                 skipped_2 = i + 1
                             else:
-                                # peek at the next one and if it might be useful, add some interest
+                                # peek at the next one (if still on board) and if it might be useful, add some interest
+                                if ext_r-dr < 0 or ext_r-dr >= board_size or ext_c-dc < 0 or ext_c-dc >= board_size:
+                                    break
                                 if state[ext_r-dr, ext_c-dc] == -player:
                                     interest_value += 15
                                 break
@@ -586,94 +731,6 @@ def i_win(state, last_move, player):
             return True # 5 in a row
     return False
 
-@numba.jit(nopython=True, nogil=True)
-def i_lost(state, player):
-    for r in range(board_size):
-        for c in range(board_size):
-            if state[r,c] == 0 and i_win(state, (r,c), -player):
-                return True
-    return False
-
-@numba.jit(nopython=True, nogil=True)
-def i_will_win(state, last_move, player):
-    """ Return true if I will win next step if the opponent don't have 4-in-a-row.
-    Winning Conditions:
-        1. 5 in a row.
-        2. 4 in a row with both end open. (free 4)
-        3. 4 in a row with one missing stone x 2 (hard 4 x 2)
-     """
-    r, c = last_move
-    # try all 4 directions, the other 4 is equivalent
-    directions = [(1,1), (1,0), (0,1), (1,-1)]
-    n_hard_4 = 0 # number of hard 4s found
-    for dr, dc in directions:
-        line_length = 1 # last_move
-        # try to extend in the positive direction (max 5 times to check overline)
-        ext_r = r
-        ext_c = c
-        skipped_1 = 0
-        for i in range(5):
-            ext_r += dr
-            ext_c += dc
-            if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
-                break
-            elif state[ext_r, ext_c] == player:
-                line_length += 1
-            elif skipped_1 == 0 and state[ext_r, ext_c] == 0:
-                skipped_1 = i+1 # allow one skip and record the position of the skip
-            else:
-                break
-        # try to extend in the opposite direction
-        ext_r = r
-        ext_c = c
-        skipped_2 = 0
-        # the backward counting starts at the furthest "unskipped" stone
-        if skipped_1 != 0:
-            line_length_back = skipped_1
-        else:
-            line_length_back = line_length
-        line_length_no_skip = line_length_back
-        for i in range(6-line_length_back):
-            ext_r -= dr
-            ext_c -= dc
-            if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
-                break
-            elif state[ext_r, ext_c] == player:
-                line_length_back += 1
-            elif skipped_2 == 0 and state[ext_r, ext_c] == 0:
-                skipped_2 = i + 1
-            else:
-                break
-
-        if line_length_back == 6:
-            # we found 6 stones in a row, this is overline, skip this entire line
-            continue
-        elif line_length_back == 5:
-            if (skipped_2 == 0) or (skipped_2 == (6-line_length_no_skip)):
-                # we found 5 stones in a row, because the backward counting is not skipped in the middle
-                return True
-                # else there is an empty spot in the middle of 6 stones, it's not a hard 4 any more
-        elif line_length_back == 4:
-            # here we have only 4 stones, if skipped in back count, it's a hard 4
-            if skipped_2 != 0:
-                n_hard_4 += 1 # backward hard 4
-                if n_hard_4 == 2:
-                    return True # two hard 4
-        # here we check if there's a hard 4 in the forward direction
-        # extend the forward line to the furthest "unskipped" stone
-        if skipped_2 == 0:
-            line_length += line_length_back - line_length_no_skip
-        else:
-            line_length += skipped_2 - 1
-        # hard 4 only if forward length is 4, if forward reaches 5 or more, it's going to be overline
-        if line_length == 4 and skipped_1 != 0:
-            n_hard_4 += 1 # forward hard 4
-            if n_hard_4 == 2:
-                return True # two hard 4 or free 4
-    return False
-
-
-
 from collections import OrderedDict
 class LRU(OrderedDict):
     'Limit size, evicting the least recently looked-up key when full'
@@ -695,61 +752,261 @@ class LRU(OrderedDict):
             oldest = next(iter(self))
             del self[oldest]
 
-class LeveledCache:
+# bound types of cached values, values from a cutoff search are only bounds of the true value
+BOUND_EXACT = 0
+BOUND_LOWER = 1 # true value >= cached value
+BOUND_UPPER = 2 # true value <= cached value
+
+def search_bound(q, alpha, beta):
+    """ Classify the fail-soft result q of a search with window (alpha, beta) """
+    if q >= 1.0 or q <= -1.0:
+        # a proven win or lose can not be improved
+        return BOUND_EXACT
+    elif q <= alpha:
+        return BOUND_UPPER
+    elif q >= beta:
+        return BOUND_LOWER
+    return BOUND_EXACT
+
+ARRAY_CACHE_SLOT_STEP = 256 # the number of slots of an array table is a multiple of this, so the table is whole 4kB pages
+
+def array_cache_slots(maxsize, max_bytes=None):
     """
-    Cache with level system, level 0 has highest priority
-    When maxsize reached, oldest key from lowest cache will be deleted
+    Number of slots of an array table, for at least maxsize entries or at most max_bytes bytes (16 bytes per slot),
+    the 16 bytes of the header (age and model) are counted in max_bytes too. The smallest table has ARRAY_CACHE_SLOT_STEP slots
     """
+    if max_bytes is not None:
+        n_slots = (max_bytes - 16) // 16 // ARRAY_CACHE_SLOT_STEP * ARRAY_CACHE_SLOT_STEP
+    else:
+        n_slots = -(-maxsize // ARRAY_CACHE_SLOT_STEP) * ARRAY_CACHE_SLOT_STEP
+    return max(n_slots, ARRAY_CACHE_SLOT_STEP)
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def array_cache_current(data, model):
+    """ Return true if the entry data is proven (model 0) or from model, the values of older models are stale """
+    entry_model = np.int64((data >> np.uint64(50)) & np.uint64(0x3F))
+    return entry_model == 0 or entry_model == model
 
-    def __init__(self, maxlevel, maxsize=128):
+@numba.jit(nopython=True, nogil=True, cache=True)
+def array_cache_lookup(checks, datas, key, min_level, alpha, beta, any_bound, model):
+    """
+    Find the highest level entry of key in its bucket that has level >= min_level and is usable in (alpha, beta),
+    or with any bound if any_bound. Entries of other models than model are skipped. Return (found, value, proven)
+    """
+    slot = (key % np.uint64(len(datas) // 2)) * np.uint64(2)
+    found = False
+    best_level = -1
+    best_value = 0.0
+    best_proven = False
+    for s in range(slot, slot+np.uint64(2)):
+        data = datas[s]
+        # an entry torn by a concurrent write fails this check
+        if data == 0 or checks[s] ^ data != key or not array_cache_current(data, model):
+            continue
+        level = np.int64((data >> np.uint64(32)) & np.uint64(0xFFFF)) - 1
+        bound = np.int64((data >> np.uint64(48)) & np.uint64(0x3))
+        value = np.float64(np.array([data & np.uint64(0xFFFFFFFF)]).astype(np.uint32).view(np.float32)[0])
+        if level < min_level or level <= best_level:
+            continue
+        if any_bound or bound == BOUND_EXACT or (bound == BOUND_LOWER and value >= beta) or (bound == BOUND_UPPER and value <= alpha):
+            found = True
+            best_level = level
+            best_value = value
+            best_proven = (data >> np.uint64(50)) & np.uint64(0x3F) == 0
+    return found, best_value, best_proven
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def array_cache_store(checks, datas, key, value, level, bound, age, model, proven):
+    """
+    Store an entry of key in its bucket. An entry of the same key is replaced unless it has higher level,
+    or is exact at the same level while the new one is a bound (a higher level bound goes to the other slot
+    so both are kept). A new key takes the first slot if its level is at least as high or the entry there
+    is from an older search (age) or model, pushing the old entry to the second slot, otherwise it replaces the second slot
+    The entry is tagged with model, or with 0 if proven, then it holds for any model
+    """
+    slot = (key % np.uint64(len(datas) // 2)) * np.uint64(2)
+    level = max(level, 0)
+    value_bits = np.array([value], dtype=np.float32).view(np.uint32)[0]
+    new_data = (np.uint64(value_bits) | (np.uint64(level + 1) << np.uint64(32)) | (np.uint64(bound) << np.uint64(48))
+                | (np.uint64(0 if proven else model) << np.uint64(50)) | (np.uint64(age) << np.uint64(56)))
+    for s in range(slot, slot+np.uint64(2)):
+        data = datas[s]
+        if data != 0 and checks[s] ^ data == key and array_cache_current(data, model):
+            old_level = np.int64((data >> np.uint64(32)) & np.uint64(0xFFFF)) - 1
+            old_bound = np.int64((data >> np.uint64(48)) & np.uint64(0x3))
+            if level < old_level or (level == old_level and bound != BOUND_EXACT and old_bound == BOUND_EXACT):
+                return
+            if bound != BOUND_EXACT and old_bound == BOUND_EXACT:
+                # keep the exact value of the lower level too
+                s = slot + (s - slot + np.uint64(1)) % np.uint64(2)
+            datas[s] = new_data
+            checks[s] = key ^ new_data
+            return
+    data = datas[slot]
+    if (data == 0 or level >= np.int64((data >> np.uint64(32)) & np.uint64(0xFFFF)) - 1
+            or np.int64(data >> np.uint64(56)) != age or not array_cache_current(data, model)):
+        datas[slot+np.uint64(1)] = data
+        checks[slot+np.uint64(1)] = checks[slot]
+        s = slot
+    else:
+        s = slot + np.uint64(1)
+    datas[s] = new_data
+    checks[s] = key ^ new_data
+
+class ArrayCache:
+    """
+    Fixed size transposition table in numpy arrays, 16 bytes per entry, level 0 has highest priority
+    Each bucket has two entries, one kept for better levels and one always replaced
+    An entry is stored as (key ^ data, data) in two words, so an entry torn by a concurrent write fails the key check
+    The levels are stored as maxlevel - level, so the kernels keep and prefer level 0
+    The age is bumped by new_search at every move, entries of older moves give way to new ones even at better levels
+    The model is bumped by new_model, the proven wins and losses are stored with model 0 and kept for all models
+    """
+
+    def __init__(self, maxlevel, maxsize=128, max_bytes=None):
         assert maxlevel >= 0
         self.maxlevel = maxlevel
-        self.maxsize = maxsize
-        self.caches = [OrderedDict() for _ in range(maxlevel+1)]
-        self.size = 0
-    
-    def get(self, key, max_accepted_level):
+        n_slots = array_cache_slots(maxsize, max_bytes)
+        self.maxsize = n_slots
+        self.checks = np.zeros(n_slots, dtype=np.uint64)
+        self.datas = np.zeros(n_slots, dtype=np.uint64)
+        self.header = np.ones(2, dtype=np.uint64) # the age and the model, next to the table for the shared table
+        self.digest = None # model_digest of the weights the values are from, set by AIPlayer.reset_cache
+
+    @property
+    def age(self):
+        return int(self.header[0])
+
+    def new_search(self):
+        """ Start a new search, the entries stored so far get older """
+        self.header[0] = self.age % 255 + 1
+
+    def get(self, key, max_accepted_level, alpha=-2.0, beta=2.0):
         """
-        Go over each level in cache, find one value with key
+        Find the value of key with the lowest level <= max_accepted_level that is usable in the (alpha, beta) window
+        Exact values are always usable, lower bounds only when >= beta, upper bounds only when <= alpha
         If none found, return None
         """
-        for level in range(min(self.maxlevel, max_accepted_level)+1):
-            # starting from level 0, look for cached value
-            cache = self.caches[level]
-            try:
-                result = cache[key]
-                cache.move_to_end(key)
-                return result
-            except KeyError:
-                pass
-        return None
-        
-    def set(self, key, value, level):
+        entry = self.get_entry(key, max_accepted_level, alpha, beta)
+        return None if entry is None else entry[0]
+
+    def get_entry(self, key, max_accepted_level, alpha=-2.0, beta=2.0):
+        """ Same as get, but return (value, proven) or None, proven values hold for any model """
+        found, value, proven = array_cache_lookup(self.checks, self.datas, np.uint64(key), self.maxlevel - max_accepted_level, alpha, beta, False, self.model)
+        return (value, proven) if found else None
+
+    def set(self, key, value, level, bound=BOUND_EXACT, proven=False):
         """
-        set a value in cache with level
+        set a value in cache with level and bound type
+        proven values come from the ends of the game or only from other proven values, they do not depend on the model
         """
         assert level <= self.maxlevel
-        # delete oldest from lowest cache if size reached
-        if self.size >= self.maxsize:
-            for l in range(self.maxlevel, -1, -1):
-                cache = self.caches[l]
-                try:
-                    oldest = next(iter(cache))
-                    del cache[oldest]
-                    break
-                except StopIteration:
-                    # if cache is empty skip and go to the next level cache
-                    pass
-        else:
-            # update size
-            self.size += 1
-        # insert new key
-        cache = self.caches[level]
-        # move key to end
-        if key in cache:
-            cache.move_to_end(key)
-        # set the value
-        cache[key] = value
+        array_cache_store(self.checks, self.datas, np.uint64(key), value, self.maxlevel - level, bound, self.age, self.model, proven)
+
+    @property
+    def model(self):
+        return int(self.header[1])
+
+    @property
+    def nbytes(self):
+        """ Bytes of the table, it has a fixed size """
+        return self.header.nbytes + self.checks.nbytes + self.datas.nbytes
+
+    def usage(self):
+        """
+        Bytes taken by the entries of each level that are still used (proven or of the current model), by level
+        It scans the whole table, for tests and stats only, not for the searches
+        """
+        datas = self.datas
+        models = (datas >> np.uint64(50)) & np.uint64(0x3F)
+        used = datas[(datas != 0) & ((models == 0) | (models == self.model))]
+        levels = ((used >> np.uint64(32)) & np.uint64(0xFFFF)).astype(np.int64) - 1
+        return {self.maxlevel - level: 16 * int(n) for level, n in enumerate(np.bincount(levels)) if n > 0}
+
+    def new_model(self):
+        """
+        Switch to a new model, the values of the old model are no longer used and get replaced as the search goes,
+        the proven values are kept. The model number is 6 bits, the entries left from the last model with
+        the new number (63 models ago) are removed right away
+        """
+        model = self.model % 63 + 1
+        stale = ((self.datas >> np.uint64(50)) & np.uint64(0x3F)) == model
+        self.datas[stale] = 0
+        self.checks[stale] = 0
+        self.header[1] = model
+
+def model_digest(model):
+    """ Short hash of the model weights, processes with the same weights get the same digest """
+    h = hashlib.sha1()
+    if hasattr(model, 'state_dict'):
+        for name, weights in model.state_dict().items():
+            h.update(name.encode())
+            h.update(weights.detach().cpu().numpy().tobytes())
+    else:
+        h.update(pickle.dumps(model))
+    # shared memory names are limited to 30 characters on macos
+    return h.hexdigest()[:8]
+
+def attach_shared_memory(name):
+    """
+    Attach to an existing block of shared memory without registering it with the resource tracker,
+    which would remove the block when this process exits (track=False from python 3.13)
+    """
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+class SharedArrayCache(ArrayCache):
+    """
+    ArrayCache in a block of shared memory, so that processes on the same host search with one table
+    The first process opening a name creates the block and the others attach to it, e.g. the self-play processes
+    The processes write without locks like the threads of ArrayCache, the age and the model are kept in the block too
+    so the processes sharing a block should play with the same model, AIPlayer tags the name with its weights
+    The creator removes the block on close, or when it exits
+    """
+
+    def __init__(self, name=None, maxlevel=0, maxsize=128, max_bytes=None):
+        self.maxlevel = maxlevel # maxlevel - level is the depth left, so players of any level can share a table
+        n_slots = array_cache_slots(maxsize, max_bytes)
+        try:
+            # two words for the age and the model, then the checks and the datas
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=16 + 16*n_slots)
+            self.owner = True
+        except FileExistsError:
+            self.shm = attach_shared_memory(name)
+            self.owner = False
+            # the size of the existing block decides, the block can be rounded up to whole pages
+            n_slots = (self.shm.size - 16) // 16 // ARRAY_CACHE_SLOT_STEP * ARRAY_CACHE_SLOT_STEP
+        self.name = self.shm.name
+        self.maxsize = n_slots
+        self.digest = None
+        self.header = np.ndarray(2, dtype=np.uint64, buffer=self.shm.buf)
+        self.checks = np.ndarray(n_slots, dtype=np.uint64, buffer=self.shm.buf, offset=16)
+        self.datas = np.ndarray(n_slots, dtype=np.uint64, buffer=self.shm.buf, offset=16 + 8*n_slots)
+        if self.owner:
+            self.header[:] = 1
+            # otherwise the block is left behind, and reported as leaked by the resource tracker
+            atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ Detach from the block, the creator also removes it (processes still attached keep using it) """
+        if self.shm is None:
+            return
+        self.header = self.checks = self.datas = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+            atexit.unregister(self.close)
+        self.shm = None
 
 
 
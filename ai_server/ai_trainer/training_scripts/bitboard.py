@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+# bitboard representation of the board, every line of the board (rows, columns and both diagonals)
+# is kept as a bitmask of each player, bit i is the i-th spot along the line
+# pattern checks are then a few shifts and ANDs on a line instead of walking the spots one by one
+# a five is exactly 5 in a row like i_win, overlines do not count
+
+import numba
+import numpy as np
+
+board_size = 15
+DIRECTIONS = ((1,1), (1,0), (0,1), (1,-1))
+
+def build_line_tables():
+    """
+    Number all lines of the board: 29 diagonals, 15 columns, 15 rows, 29 anti-diagonals, in the order of DIRECTIONS
+    Return (line_index, line_pos, line_full)
+    line_index[r, c, d], line_pos[r, c, d]: the line of spot (r, c) in direction d and its bit on that line
+    line_full[line]: mask with all bits of the line set
+    """
+    line_index = np.zeros((board_size, board_size, 4), dtype=np.int64)
+    line_pos = np.zeros((board_size, board_size, 4), dtype=np.int64)
+    cells = []
+    for d, (dr, dc) in enumerate(DIRECTIONS):
+        for r in range(board_size):
+            for c in range(board_size):
+                # a line starts at a spot whose previous spot in direction d is off the board
+                pr, pc = r - dr, c - dc
+                if 0 <= pr < board_size and 0 <= pc < board_size:
+                    continue
+                line = []
+                sr, sc = r, c
+                while 0 <= sr < board_size and 0 <= sc < board_size:
+                    line_index[sr, sc, d] = len(cells)
+                    line_pos[sr, sc, d] = len(line)
+                    line.append((sr, sc))
+                    sr, sc = sr + dr, sc + dc
+                cells.append(line)
+    line_full = np.zeros(len(cells), dtype=np.int64)
+    for i, line in enumerate(cells):
+        line_full[i] = (1 << len(line)) - 1
+    return line_index, line_pos, line_full
+
+LINE_INDEX, LINE_POS, LINE_FULL = build_line_tables()
+N_LINES = len(LINE_FULL) # 88
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def place_stone(lines, r, c, player):
+    """ Put a stone of player at (r, c) on the bitboard """
+    p = 0 if player == 1 else 1
+    for d in range(4):
+        lines[p, LINE_INDEX[r, c, d]] |= 1 << LINE_POS[r, c, d]
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def remove_stone(lines, r, c, player):
+    """ Take the stone of player at (r, c) off the bitboard """
+    p = 0 if player == 1 else 1
+    for d in range(4):
+        lines[p, LINE_INDEX[r, c, d]] &= ~(1 << LINE_POS[r, c, d])
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def line_fives(mine):
+    """ The first bits of the runs of exactly 5 stones in a line """
+    runs = mine & (mine >> 1) & (mine >> 2) & (mine >> 3) & (mine >> 4)
+    # no stone right before or right after the run, that would be an overline
+    return runs & ~(mine << 1) & ~(mine >> 5)
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def line_five_points(mine, empty):
+    """ The empty spots of a line where a stone makes exactly 5 in a row """
+    points = 0
+    for k in range(5):
+        # windows of 5 starting at each bit, with the empty spot at k and my stones at the other 4
+        windows = empty >> k
+        for j in range(5):
+            if j != k:
+                windows &= mine >> j
+        points |= (windows & ~(mine << 1) & ~(mine >> 5)) << k
+    return points
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def count_bits(x):
+    """ Number of set bits of a line mask (at most 16 bits) """
+    x = x - ((x >> 1) & 0x5555)
+    x = (x & 0x3333) + ((x >> 2) & 0x3333)
+    x = (x + (x >> 4)) & 0x0F0F
+    return (x + (x >> 8)) & 0x1F
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def five_through(lines, r, c, player):
+    """ Return true if player has exactly 5 in a row through (r, c) """
+    p = 0 if player == 1 else 1
+    for d in range(4):
+        pos = LINE_POS[r, c, d]
+        # the runs that start at most 4 spots before (r, c)
+        if line_fives(lines[p, LINE_INDEX[r, c, d]]) & ((0x1F << pos) >> 4):
+            return True
+    return False
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def update_five_points(lines, points, n_points, r, c):
+    """
+    Recompute the five points of both players on the 4 lines through (r, c) after its stone changed
+    points[p, line] is the mask of the spots where player p makes 5 on that line, n_points[p] the total of its bits
+    """
+    for d in range(4):
+        line = LINE_INDEX[r, c, d]
+        empty = LINE_FULL[line] & ~(lines[0, line] | lines[1, line])
+        for p in range(2):
+            mine = lines[p, line]
+            new_points = line_five_points(mine, empty) if count_bits(mine) >= 4 else 0
+            n_points[p] += count_bits(new_points) - count_bits(points[p, line])
+            points[p, line] = new_points
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def set_spot(board, lines, points, n_points, r, c, stone):
+    """ Put stone (0 to take it back) at (r, c) of board, its lines and their five points """
+    if board[r, c] != 0:
+        remove_stone(lines, r, c, board[r, c])
+    if stone != 0:
+        place_stone(lines, r, c, stone)
+    board[r, c] = stone
+    update_five_points(lines, points, n_points, r, c)
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def sync_lines(board, state, lines, points, n_points):
+    """
+    Bring lines and five points from board to state by placing and removing the stones that changed,
+    board is updated too
+    """
+    for r in range(board_size):
+        for c in range(board_size):
+            if board[r, c] != state[r, c]:
+                set_spot(board, lines, points, n_points, r, c, state[r, c])
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def move_result(lines, points, n_points, r, c, player):
+    """
+    The game ending checks after player played (r, c), in the order i win, i lost, i will win:
+    return 1 if player won or will win next move, -1 if the opponent can make 5 next move, 0 otherwise
+    """
+    if five_through(lines, r, c, player):
+        return 1
+    # the opponent's five points are tracked, no need to scan the board
+    if n_points[1 if player == 1 else 0] > 0:
+        return -1
+    # two different lines through (r, c) only meet at (r, c), so no spot is counted twice
+    p = 0 if player == 1 else 1
+    n = 0
+    for d in range(4):
+        n += count_bits(points[p, LINE_INDEX[r, c, d]])
+    if n >= 2:
+        return 1
+    return 0
+
+class Bitboard:
+    """
+    Line bitmasks and five points of its board. The search places and removes each stone on the bitboard too,
+    where it places it on the board. sync compares the whole board, at the first position of a search
+    or after a search was stopped
+    """
+
+    def __init__(self):
+        self.board = np.zeros((board_size, board_size), dtype=np.int8)
+        self.lines = np.zeros((2, N_LINES), dtype=np.int64)
+        self.points = np.zeros((2, N_LINES), dtype=np.int64)
+        self.n_points = np.zeros(2, dtype=np.int64)
+
+    def sync(self, state):
+        """ Bring the bitboard to state, return its line bitmasks """
+        sync_lines(self.board, state, self.lines, self.points, self.n_points)
+        return self.lines
+
+    def place(self, r, c, player):
+        set_spot(self.board, self.lines, self.points, self.n_points, r, c, player)
+
+    def remove(self, r, c):
+        set_spot(self.board, self.lines, self.points, self.n_points, r, c, 0)
+
+    def move_result(self, r, c, player):
+        """ See move_result, the stone of player at (r, c) is placed already """
+        return move_result(self.lines, self.points, self.n_points, r, c, player)
+
+    def n_five_points(self, player):
+        """ Number of spots where player makes 5 (a spot on two lines counts twice), > 0 means a four """
+        return self.n_points[0 if player == 1 else 1]
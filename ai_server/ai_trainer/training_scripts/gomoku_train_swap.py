@@ -290,7 +290,7 @@ def refine_train_data(player, learndata_A, learndata_B):
     for i, k in enumerate(learndata_A.keys()):
         x, y, n = learndata_A[k]
         # let white player evaluate this
-        _, opponent_q = player.best_action_q(x, 225, 1, -1, -1)
+        _, opponent_q = player.best_action_q(x, 225, -2.0, 2.0, -1)
         new_y = -opponent_q
         diff += (new_y-y)**2
         learndata_A[k] = x, new_y, n
@@ -301,7 +301,7 @@ def refine_train_data(player, learndata_A, learndata_B):
     for i, k in enumerate(learndata_B.keys()):
         x, y, n = learndata_B[k]
         # let black player evaluate this
-        _, opponent_q = player.best_action_q(x, 225, 1, -1, 1)
+        _, opponent_q = player.best_action_q(x, 225, -2.0, 2.0, 1)
         new_y = -opponent_q
         diff += (new_y-y)**2
         learndata_B[k] = x, new_y, n
@@ -335,6 +335,8 @@ def main():
     parser.add_argument('-p', '--begin_lib_p', type=float, default=1.0, help='Possibility of begin lib to be used')
     parser.add_argument('-r', '--refine_data', action='store_true', help='Use a higher level AI to refine data before training')
     parser.add_argument('-b', '--benchmark', action='store_true', default=False, help='Enable benchmark after each training model')
+    parser.add_argument('-s', '--shared_cache', help='Name of a search cache in shared memory, self-play processes with the same name and model share it (the name is tagged with the model weights)')
+    parser.add_argument('-m', '--cache_mb', type=int, help='Memory budget of the search cache in MB, 2M entries if not set')
     args = parser.parse_args()
 
     game = Gomoku(board_size=15, first_center=False)
@@ -382,13 +384,14 @@ def main():
 
 
     from AIPlayer import AIPlayer
-    player_A = AIPlayer('Black', model)
-    player_B = AIPlayer('White', model)
+    cache_bytes = args.cache_mb * 2**20 if args.cache_mb is not None else None
+    player_A = AIPlayer('Black', model, shared_cache=args.shared_cache, cache_bytes=cache_bytes)
+    player_B = AIPlayer('White', model, shared_cache=args.shared_cache, cache_bytes=cache_bytes)
     # set up linked learndata and cache (allow AI to look into opponent's data)
     player_A.opponent = player_B
     player_B.opponent = player_A
     # share the cache
-    player_B.cache = player_A.cache
+    player_B.share_cache(player_A)
 
     game.players = [player_A, player_B]
     if args.train_step > 1:
@@ -471,9 +474,8 @@ def main():
             print("%-7s | %7d"%(name, nwin))
         # reset player cache
         player_A.reset_cache()
-        player_B.reset_cache()
         # share the cache
-        player_B.cache = player_A.cache
+        player_B.share_cache(player_A)
         # refine the data if needed
         if args.refine_data:
             refine_train_data(player_A, player_A.learndata, player_B.learndata)
@@ -484,6 +486,9 @@ def main():
         model.fit(train_X, train_Y, epochs=args.n_epoch, validation_split=0.2)
         save_model(model, MODEL_FILE)
         print("Model %s saved!" % model_name)
+        # the next games search in the shared cache of the new weights, the block of the old ones is removed
+        player_A.reset_cache()
+        player_B.share_cache(player_A)
         os.chdir('..')
         if args.benchmark and i_train > 0:
             prev_model_name = f"trained_model_{i_train-1:03d}"
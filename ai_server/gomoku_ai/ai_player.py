@@ -1,23 +1,98 @@
 #!/usr/bin/env python
 
+import os
 import time
+import atexit
+import hashlib
+import pickle
+import threading
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
 import numba
 import numpy as np
 
+from gomoku_ai.threat_space import find_vcf, VCF_MAX_DEPTH, VCF_MAX_NODES, VCF_LEAF_MAX_NODES
+from gomoku_ai.bitboard import Bitboard
+
 board_size = 15
 show_q = False
 
+class SearchTimeout(Exception):
+    """ Raised inside the search when the time budget of a prediction is used up """
+    pass
+
+class SearchControl:
+    """
+    Deadline and stop flag of a search, one object shared by the player and its helpers, so setting them
+    reaches every search running on it
+    """
+
+    def __init__(self):
+        self.deadline = None # wall clock time when the search should stop
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def timed_out(self):
+        return self.stopped or (self.deadline is not None and time.time() > self.deadline)
+
+class WorkerControl(SearchControl):
+    """ Control of a task in a root worker process, the task is also stopped once the pool moves on to another search """
+
+    def __init__(self, deadline, search_ids, search_id):
+        super().__init__()
+        self.deadline = deadline
+        self.search_ids = search_ids # the id of the current search of the pool, in shared memory
+        self.search_id = search_id
+
+    def timed_out(self):
+        return self.search_ids.value != self.search_id or super().timed_out()
+
 class AIPlayer:
-    def __init__(self, name, model=None, level=0):
+    def __init__(self, name, model=None, level=0, time_limit=None, max_level=10, symmetric_cache=True, leaf_batch_size=None,
+                 engine='minimax', mcts_playouts=800, n_workers=None, reduce_late_moves=None, width_ratio=None,
+                 quiescence_plies=None, shared_cache=None, cache_file=None, cache_bytes=None, cache=None, control=None):
         self.name = name
         self.load_model(model)
         self.level = level # level 0 means direct check all my moves against dnn model and pick the highest score
+        self.time_limit = time_limit # seconds per prediction, if set use iterative deepening instead of a fixed level
+        self.max_level = max_level # deepest level iterative deepening will try
+        self.control = SearchControl() if control is None else control # deadline and stop flag of the running search, shared with the helpers
+        self.n_symmetries = SYMMETRIES if symmetric_cache else 1 # share cache between rotated / flipped positions
+        self.leaf_batch_size = leaf_batch_size # if set, search root moves side by side and evaluate their leaves in batches of this size
+        self.helpers = [] # players sharing model and cache, used to run searches side by side
+        self.engine = engine # 'minimax' or 'mcts', an aiLevel of 'mcts' in the web game state also selects mcts
+        self.mcts_playouts = mcts_playouts # playouts per prediction of the mcts engine, when there is no time limit
+        self.n_workers = n_workers # if set, root moves of level 2+ searches are split across a pool of this many processes
+        self.pool = None
+        self.pool_search_ids = None # id of the current search of the pool, bumped to stop the tasks of a search
+        self.shared_cache = shared_cache # if set, the name of a cache in shared memory used by all processes opening it with the same model
+        self.cache_file = cache_file # if set, the cache is kept in this memory mapped file across restarts, instead of shared memory
+        self.cache_bytes = cache_bytes # memory budget of the cache in bytes, 2M entries (32MB) if None
+        # selective search, all off by default
+        self.reduce_late_moves = reduce_late_moves # if set, the moves after this many are searched one level shallower first
+        self.width_ratio = width_ratio # if set, moves with interest below this ratio of the top move are not searched
+        # if set, a leaf move that makes a four is searched on with the forced block instead of the dnn, up to this many plies
+        # past the level (e.g. 2). It doubles the dnn positions of level 3 searches with a cap of 8
+        self.quiescence_plies = quiescence_plies
         self.learndata = dict()
         self.opponent = None
+        self.game_pvs = LRU(maxsize=PV_MAX_GAMES) # principal variation and level of the last predictions, by move history
+        self.unsolved_positions = LRU(maxsize=PN_UNSOLVED_POSITIONS) # positions the endgame solver could not solve, by cache key
+        self.vcf_results = LRU(maxsize=VCF_CACHED_POSITIONS) # find_vcf results, by zobrist hash, player and node budget
+        self.ponder_thread = None # background search of the replies to the last prediction, see start_pondering
         self.all_interest_states = np.zeros(board_size**4 * 3, dtype=np.float32).reshape(board_size**2, 3, board_size, board_size)
         self.move_interest_values = np.zeros(board_size**2, dtype=np.float32).reshape(board_size,board_size)
+        self.interest_map = InterestMap() # interesting moves are updated from the last searched position
+        self.bitboard = Bitboard() # line bitmasks for the game ending checks, follows the moves of the search
+        self.extended_plies = 0 # plies the running search has extended past its level for forcing moves
         self.reset()
-        self.reset_cache()
+        # if a cache is given, search with it and make none of its own
+        self.cache = cache
+        self.mcts = None
+        if cache is None:
+            self.reset_cache()
 
     def load_model(self, model):
         # no data
@@ -36,22 +111,70 @@ class AIPlayer:
         self.hist_states = []
         self.surprised = False
         self.started_from_beginning = True
+        self.reset_move_ordering()
+
+    def reset_move_ordering(self):
+        """ Forget the move ordering heuristics, they are kept through the predictions of a game """
+        self.history = np.zeros((2, board_size, board_size)) # score of each move of each player that was best or cut off the search
+        self.killers = [[] for _ in range(board_size**2+1)] # last 2 moves that cut off the search, by empty_spots_left (the ply)
+        self.game_history = [] # moves of the game of the last prediction
 
     def reset_cache(self):
-        """ Reset cache before using new model """
-        self.cache = LeveledCache(maxsize=2000000)
+        """
+        Reset cache before using new model, the proven wins and losses are kept
+        A cache shared by name is tagged with the model weights, a new model moves to the block of its own tag
+        Nothing changes if the cache holds the values of these weights already, e.g. reset by another player sharing it
+        """
+        digest = model_digest(self.model)
+        shared_name = None
+        if self.shared_cache is not None and self.cache_file is None:
+            shared_name = f"{self.shared_cache}_{digest}"
+        if self.cache is not None and (shared_name is None or self.cache.name == shared_name):
+            if self.cache.digest != digest:
+                # the values of the old model are not used anymore, by all processes sharing the cache
+                self.cache.new_model()
+        elif self.cache_file is not None:
+            self.cache = MappedArrayCache(self.cache_file, maxsize=2000000, flush_interval=CACHE_FLUSH_INTERVAL, max_bytes=self.cache_bytes)
+        elif shared_name is not None:
+            # one table in shared memory for the processes on this host searching with this model, and their root workers
+            self.close_cache()
+            self.cache = SharedArrayCache(shared_name, maxsize=2000000, max_bytes=self.cache_bytes)
+        elif self.n_workers is not None:
+            # a new block for this player and its root workers
+            self.cache = SharedArrayCache(maxsize=2000000, max_bytes=self.cache_bytes)
+        else:
+            # fixed size table, also shared by the pondering thread
+            self.cache = ArrayCache(maxsize=2000000, max_bytes=self.cache_bytes)
+        self.cache.digest = digest
+        self.mcts = None # the mcts tree is built with the old model too
+        if self.pool is not None:
+            # the workers hold the old model
+            self.pool.terminate()
+            self.pool = None
+            self.pool_search_ids = None
 
+    def close_cache(self):
+        """ Release the cache, a block of shared memory created by this player is removed """
+        if self.cache is not None and hasattr(self.cache, 'close'):
+            self.cache.close()
+        self.cache = None
 
     def predict(self, web_game_state):
         """
         Run AI prediction for all interested moves, return structured prediction data to web frontend
         """
+        self.stop_pondering() # the helpers and cache are needed for this search now
         server_game_state = self.server_game_state(web_game_state)
         # update level
         self.level = web_game_state.get('aiLevel', 1)
+        # time budget in seconds, per request or from server config
+        time_limit = web_game_state.get('timeLimit', self.time_limit)
         # prepare inputs
         state = server_game_state['state']
-        print(f"Starting prediction with level = {self.level}")
+        if time_limit is None:
+            print(f"Starting prediction with level = {self.level}")
+        else:
+            print(f"Starting prediction with time limit = {time_limit}s")
         show_state(state)
         player = server_game_state['player']
         empty_spots_left = server_game_state['empty_spots_left']
@@ -61,17 +184,41 @@ class AIPlayer:
         self.move_interest_values[4:11, 4:11] = 5.0 # manually assign higher interest in middle
         interested_moves = find_interesting_moves(state, empty_spots_left, self.move_interest_values, player, n_moves, False)
         # predict winrate
-        moveWinrates = []
-        for move in interested_moves:
-            winrate = self.single_move_winrate(state, empty_spots_left, move, player, self.level-1)
-            moveWinrates.append([int(move[0]), int(move[1]), float(winrate*0.5+0.5)])
-
-
-        # winrates = self.dnn_evaluate(state, interested_moves, player)
-        # for move, winrate in zip(interested_moves, winrates):
-        #     # convert winrate from range (-1, 1) to (0, 1)
-        #     moveWinrates.append([int(move[0]), int(move[1]), float(winrate*0.5+0.5)])
-        moveWinrates.sort(key=lambda l:l[-1], reverse=True)
+        if self.level == 'mcts' or self.engine == 'mcts':
+            # mcts returns the most visited moves first
+            moveWinrates = self.mcts_winrates(state, empty_spots_left, player, web_game_state['moveHistory'], time_limit)
+        else:
+            t_start = time.time()
+            self.cache.new_search()
+            self.solve_root_vcf(state, player)
+            self.solve_endgame(state, empty_spots_left, player, time_limit)
+            history = [(int(m[0]), int(m[1])) for m in web_game_state['moveHistory']]
+            if history[:len(self.game_history)] != self.game_history:
+                # another game, or moves were taken back, the good moves of the last prediction are not known to be good here
+                self.reset_move_ordering()
+            self.game_history = history
+            self.history *= 0.5 # the history of earlier predictions counts less
+            start_level = 1
+            resumed = self.resume_search(web_game_state['moveHistory'], state, player)
+            if resumed is not None:
+                # the game went on as an earlier prediction expected, its best move here goes first
+                # and the levels its subtree was searched with already can be skipped
+                pv, start_level = resumed
+                first = np.flatnonzero((interested_moves[:,0] == pv[0][0]) & (interested_moves[:,1] == pv[0][1]))
+                if len(first) > 0:
+                    interested_moves = np.roll(interested_moves, -first[0], axis=0)
+                print(f"Resuming the principal variation {pv}, from level {start_level}")
+            if time_limit is None:
+                moveWinrates = self.root_winrates(state, empty_spots_left, interested_moves, player, self.level)
+            else:
+                # the time the solver took counts too
+                moveWinrates = self.iterative_deepening(state, empty_spots_left, interested_moves, player, time_limit - (time.time() - t_start), start_level)
+            # winrates = self.dnn_evaluate(state, interested_moves, player)
+            # for move, winrate in zip(interested_moves, winrates):
+            #     # convert winrate from range (-1, 1) to (0, 1)
+            #     moveWinrates.append([int(move[0]), int(move[1]), float(winrate*0.5+0.5)])
+            moveWinrates.sort(key=lambda l:l[-1], reverse=True)
+            self.remember_pv(web_game_state['moveHistory'], state, player, moveWinrates[0][:2])
         # filter out the zero winrate moves, but keep first 5 even if they're close to zero
         # moveWinrates = [m for i,m in enumerate(moveWinrates) if i < 5 or m[-1] > 0.01]
         # prepare return data that is json serielizable
@@ -81,36 +228,359 @@ class AIPlayer:
         }
         return prediction
 
-    def single_move_winrate(self, state, empty_spots_left, current_move, player, level):
+    def solve_root_vcf(self, state, player):
+        """ A forced win by continuous fours is cached as a proven win of its first move, the search finds it right away """
+        hashes = zobrist_hashes(state)
+        vcf_r, vcf_c = self.cached_vcf(state, hashes, player, VCF_MAX_NODES)
+        if vcf_r >= 0:
+            key = self.state_key(update_hashes(hashes, vcf_r, vcf_c, player, zobrist_table))
+            self.cache.set(key, 1.0, self.max_level+1, BOUND_EXACT, proven=True)
+
+    def cached_vcf(self, state, state_hashes, player, max_nodes):
+        """
+        find_vcf of player on state, the results are kept by the zobrist hash of state. It is the hash of the board
+        as it is, not the canonical key, as the winning move is a spot of this board
+        """
+        key = (int(state_hashes[0]), player, max_nodes)
+        try:
+            return self.vcf_results[key]
+        except KeyError:
+            pass
+        vcf_r, vcf_c = find_vcf(state, player, VCF_MAX_DEPTH, max_nodes)
+        self.vcf_results[key] = (int(vcf_r), int(vcf_c))
+        return self.vcf_results[key]
+
+    def solve_endgame(self, state, empty_spots_left, player, time_limit=None):
+        """
+        Late in the game, or when the opponent threatens a forced win, try to solve the position with
+        proof-number search first. Proven moves are cached as exact values, the search then finds them right away
+        The solver gets PN_TIME_SHARE of time_limit, or PN_MAX_TIME without a time limit. A position it could
+        not solve is not tried again
+        """
+        from gomoku_ai.pn_search import ProofNumberSolver, PN_MAX_EMPTY_SPOTS, PN_MAX_TIME, PN_TIME_SHARE
+        if empty_spots_left > PN_MAX_EMPTY_SPOTS and find_vcf(state, -player, VCF_MAX_DEPTH, VCF_MAX_NODES)[0] < 0:
+            return
+        key = self.state_key(zobrist_hashes(state))
+        if key in self.unsolved_positions:
+            return
+        t_start = time.time()
+        max_time = PN_MAX_TIME if time_limit is None else PN_TIME_SHARE * time_limit
+        solver = ProofNumberSolver(self.cache, self.n_symmetries, self.max_level, deadline=t_start + max_time)
+        result = solver.solve(state.copy(), empty_spots_left, player)
+        if result is None:
+            self.unsolved_positions[key] = True
+        else:
+            print(f"Proof-number search solved the position as {result} after {time.time() - t_start:.2f}s")
+
+    def start_pondering(self, web_game_state, prediction):
+        """
+        Search the positions after the predicted move and each likely reply in a background thread,
+        so the results are in the cache when the next prediction comes. Stopped by stop_pondering
+        """
+        self.stop_pondering()
+        if self.level == 'mcts' or self.engine == 'mcts' or len(prediction.get('moveWinrates', [])) == 0:
+            return
+        server_game_state = self.server_game_state(web_game_state)
+        state = server_game_state['state']
+        player = server_game_state['player']
+        best_r, best_c = prediction['moveWinrates'][0][:2]
+        state[best_r, best_c] = player
+        # search with the level of this prediction, deeper as long as there is time if the server uses a time limit
+        if self.time_limit is None:
+            levels = [self.level]
+        else:
+            levels = range(self.level, self.max_level+1)
+        # the pondering search runs on a helper with its own control, it is stopped before the next search on this player starts
+        if self.n_workers is not None:
+            self.root_worker_pool() # to be shared with the helper
+        helper = self.search_helpers(1)[0]
+        helper.control = SearchControl()
+        self.ponder_thread = threading.Thread(target=helper.ponder, args=(state, server_game_state['empty_spots_left']-1, -player, levels), daemon=True)
+        self.ponder_thread.start()
+
+    def stop_pondering(self):
+        """ Stop the pondering search right away and wait for its thread """
+        if self.ponder_thread is None:
+            return
+        # stops the search of the helper and its own helpers at their next step
+        self.helpers[0].control.stop()
+        if self.pool is not None:
+            # and the tasks of the root workers
+            self.pool_search_ids.value += 1
+        self.ponder_thread.join()
+        self.ponder_thread = None
+        print("Pondering stopped")
+
+    def ponder(self, state, empty_spots_left, opponent, levels):
+        """ For each level, search my moves after every likely reply of the opponent to move, the best replies first """
+        self.move_interest_values.fill(0)
+        replies = find_interesting_moves(state, empty_spots_left, self.move_interest_values, opponent, PONDER_REPLIES, False)
+        reply_ids = key_list(canonical_move_keys(zobrist_hashes(state), replies, opponent, self.n_symmetries, zobrist_table))
+        replies, _ = self.order_by_cache(list(replies), reply_ids)
+        try:
+            for level in levels:
+                for reply in replies:
+                    if empty_spots_left <= 1:
+                        return
+                    if self.control.timed_out():
+                        # a prediction is waiting
+                        raise SearchTimeout()
+                    state[reply[0], reply[1]] = opponent
+                    self.move_interest_values.fill(0)
+                    self.move_interest_values[4:11, 4:11] = 5.0 # same as predict
+                    interested_moves = find_interesting_moves(state, empty_spots_left-1, self.move_interest_values, -opponent, 40, False)
+                    try:
+                        # on a copy, a timeout leaves stones on the board
+                        self.root_winrates(state.copy(), empty_spots_left-1, interested_moves, -opponent, level)
+                    finally:
+                        state[reply[0], reply[1]] = 0
+                print(f"Pondering finished level {level}")
+        except SearchTimeout:
+            pass
+
+    def remember_pv(self, move_history, state, player, best_move):
+        """ Keep the principal variation of this prediction, so the search can resume from it two moves later """
+        if not isinstance(self.level, int) or self.level < 2:
+            return
+        pv = self.principal_variation(state, player, (int(best_move[0]), int(best_move[1])), 2 * self.level)
+        self.game_pvs[tuple(tuple(m) for m in move_history)] = (pv, self.level)
+
+    def resume_search(self, move_history, state, player):
+        """
+        If the last two moves of move_history are the start of the principal variation of an earlier prediction,
+        return (the rest of the variation, the level its subtree is known with in cache), otherwise None
+        """
+        key = tuple(tuple(m) for m in move_history[:-2])
+        if len(move_history) < 2 or key not in self.game_pvs:
+            return None
+        pv, level = self.game_pvs[key]
+        if len(pv) < 3 or [tuple(m[:2]) for m in move_history[-2:]] != pv[:2]:
+            return None
+        # the root moves here were searched with level-3 in the earlier search (cache level level-2), so level-2 is known
+        # make sure the cache still has the expected move, other games may have pushed it out
+        # (the swapped window accepts a value of any bound type)
+        hashes = update_hashes(zobrist_hashes(state), pv[2][0], pv[2][1], player, zobrist_table)
+        if level < 4 or self.cache.get(self.state_key(hashes), level-2, 2.0, -2.0) is None:
+            return None
+        return pv[2:], level-2
+
+    def principal_variation(self, state, player, first_move, length):
+        """ Follow the best cached replies after first_move of player, return up to length moves """
+        state = state.copy()
+        hashes = zobrist_hashes(state)
+        empty_spots_left = int(np.sum(state == 0))
+        pv = []
+        move = first_move
+        while True:
+            pv.append(move)
+            state[move] = player
+            hashes = update_hashes(hashes, move[0], move[1], player, zobrist_table)
+            empty_spots_left -= 1
+            player = -player
+            if len(pv) >= length or empty_spots_left == 0 or i_win(state, move, -player):
+                return pv
+            # the reply with the best cached value for its player
+            self.move_interest_values.fill(0)
+            n_moves = 40 if empty_spots_left > 200 else 20
+            moves = find_interesting_moves(state, empty_spots_left, self.move_interest_values, player, n_moves, False)
+            keys = key_list(canonical_move_keys(hashes, moves, player, self.n_symmetries, zobrist_table))
+            values = [self.cache.peek(k) for k in keys]
+            known = [i for i in range(len(moves)) if values[i] is not None]
+            if len(known) == 0:
+                return pv
+            best = max(known, key=lambda i: values[i])
+            move = (int(moves[best,0]), int(moves[best,1]))
+
+    def mcts_winrates(self, state, empty_spots_left, player, move_history, time_limit):
+        """ Search with the mcts engine, the tree is kept between predictions and reused """
+        if self.mcts is None:
+            from gomoku_ai.mcts import MCTS
+            self.mcts = MCTS(self.model)
+        self.mcts.model = self.model
+        return self.mcts.search(state, empty_spots_left, player, move_history, self.mcts_playouts, time_limit)
+
+    def root_winrates(self, state, empty_spots_left, interested_moves, player, level):
+        """ Compute the winrate of each root move with a search of level, return the moveWinrates list """
+        state_hashes = zobrist_hashes(state)
+        if level == 1:
+            # two-ply fast path: each root move evaluates all its replies with the dnn at once,
+            # so the replies of all root moves are gathered and evaluated in a single model call
+            winrates = self.batched_root_winrates(state, empty_spots_left, interested_moves, player, level, state_hashes, np.inf)
+        elif self.n_workers is not None:
+            winrates = self.parallel_root_winrates(state, empty_spots_left, interested_moves, player, level)
+        elif self.leaf_batch_size is not None:
+            winrates = self.batched_root_winrates(state, empty_spots_left, interested_moves, player, level, state_hashes, self.leaf_batch_size)
+        else:
+            winrates = [self.single_move_winrate(state, empty_spots_left, move, player, level-1, state_hashes) for move in interested_moves]
+        moveWinrates = []
+        for move, winrate in zip(interested_moves, winrates):
+            moveWinrates.append([int(move[0]), int(move[1]), float(winrate*0.5+0.5)])
+        return moveWinrates
+
+    def parallel_root_winrates(self, state, empty_spots_left, interested_moves, player, level):
+        """
+        Search the root moves in the worker pool, one move per task so the workers stay busy
+        The workers search with the cache of this player in shared memory or in its file, so they reuse each other's results
+        """
+        pool = self.root_worker_pool()
+        tasks = [(state, empty_spots_left, move, player, level-1, self.control.deadline, self.pool_search_ids.value) for move in interested_moves]
+        return pool.starmap(root_worker_winrate, tasks, chunksize=1)
+
+    def root_worker_pool(self):
+        """ The pool of root search workers, spawned once, they load the model and compile the numba kernels on start """
+        if self.pool is None:
+            ctx = multiprocessing.get_context('spawn')
+            self.pool_search_ids = ctx.RawValue('i', 0)
+            self.pool = ctx.Pool(self.n_workers, initializer=init_root_worker,
+                                 initargs=(self.model, self.n_symmetries, self.reduce_late_moves, self.width_ratio, self.quiescence_plies,
+                                           type(self.cache), self.cache.name, self.pool_search_ids))
+        return self.pool
+
+    def batched_root_winrates(self, state, empty_spots_left, interested_moves, player, level, state_hashes, batch_size):
+        """ Search the root moves side by side, evaluating their leaves together in batches of batch_size """
+        # each root move is searched by a helper on its own copy of the board
+        helpers = self.search_helpers(len(interested_moves))
+        searches = [helper.single_move_search(state.copy(), empty_spots_left, move, player, level-1, state_hashes)
+                    for helper, move in zip(helpers, interested_moves)]
+        return self.run_batched_searches(searches, batch_size)
+
+    def search_helpers(self, n):
+        """ Return n helper players sharing the model, cache and settings, each with its own scratch arrays """
+        while len(self.helpers) < n:
+            # made with the cache and control of this player, the helpers allocate no cache of their own
+            self.helpers.append(AIPlayer(f"{self.name} helper {len(self.helpers)}", self.model, cache=self.cache, control=self.control))
+        for helper in self.helpers[:n]:
+            helper.model = self.model
+            helper.cache = self.cache
+            helper.control = self.control
+            helper.n_symmetries = self.n_symmetries
+            helper.n_workers = self.n_workers
+            helper.pool = self.pool
+            helper.pool_search_ids = self.pool_search_ids
+            helper.leaf_batch_size = self.leaf_batch_size
+            helper.history = self.history
+            helper.reduce_late_moves = self.reduce_late_moves
+            helper.width_ratio = self.width_ratio
+            helper.quiescence_plies = self.quiescence_plies
+            helper.killers = self.killers
+            helper.vcf_results = self.vcf_results
+        return self.helpers[:n]
+
+    def run_search(self, search):
+        """ Run a search generator to the end, evaluating each of its leaf batches with the dnn model right away """
+        try:
+            dnn_inputs = next(search)
+            while True:
+                dnn_inputs = search.send(self.model.predict(dnn_inputs).ravel())
+        except StopIteration as stop:
+            return stop.value
+
+    def run_batched_searches(self, searches, batch_size):
+        """
+        Run search generators side by side, return their results in order
+        Every search runs until it yields leaf positions to evaluate and is suspended there,
+        the queued leaves are evaluated with one dnn model call once batch_size positions are waiting
+        or all searches are suspended, then the searches resume with their values
+        """
+        results = [None] * len(searches)
+        ready = [(i, None) for i in range(len(searches))] # searches that can run, with the values to send
+        waiting = [] # suspended searches with their leaf positions
+        n_waiting = 0
+        while ready or waiting:
+            if ready:
+                i, dnn_q_array = ready.pop()
+                try:
+                    dnn_inputs = searches[i].send(dnn_q_array)
+                except StopIteration as stop:
+                    results[i] = stop.value
+                    continue
+                waiting.append((i, dnn_inputs))
+                n_waiting += len(dnn_inputs)
+                if n_waiting < batch_size and ready:
+                    continue
+            # flush the queue in one batch
+            predict_y = self.model.predict(np.concatenate([dnn_inputs for _, dnn_inputs in waiting])).ravel()
+            start = 0
+            for i, dnn_inputs in waiting:
+                ready.append((i, predict_y[start:start+len(dnn_inputs)]))
+                start += len(dnn_inputs)
+            waiting = []
+            n_waiting = 0
+        return results
+
+    def iterative_deepening(self, state, empty_spots_left, interested_moves, player, time_limit, start_level=1):
+        """
+        Search the root moves with level start_level, start_level+1... until the time_limit (seconds) is used up
+        Each level starts from the best moves of the previous level and reuses its cache
+        Return the moveWinrates of the deepest completed level, or of level 1 if start_level did not finish in time
+        """
+        t_start = time.time()
+        moveWinrates = None
+        for level in range(min(start_level, self.max_level), min(self.max_level, empty_spots_left)+1):
+            if moveWinrates is not None:
+                # search the best moves from the previous level first
+                moveWinrates.sort(key=lambda l:l[-1], reverse=True)
+                interested_moves = np.array([m[:2] for m in moveWinrates], dtype=np.int64)
+            if moveWinrates is not None or level > 1:
+                # only a first search of level 1 runs without the deadline, it is quick and gives a result to return
+                self.control.deadline = t_start + time_limit
+            try:
+                # search on a copy, a timeout leaves stones on the board
+                level_winrates = self.root_winrates(state.copy(), empty_spots_left, interested_moves, player, level)
+            except SearchTimeout:
+                print(f"Level {level} stopped by time limit after {time.time() - t_start:.2f}s")
+                break
+            finally:
+                self.control.deadline = None
+            moveWinrates = level_winrates
+            self.level = level
+            print(f"Level {level} finished after {time.time() - t_start:.2f}s")
+            # deeper search can not change a proven win, or a position where all moves are decided
+            if max(m[-1] for m in moveWinrates) == 1.0 or all(m[-1] in (0.0, 1.0) for m in moveWinrates):
+                break
+            if time.time() - t_start > time_limit:
+                break
+        if moveWinrates is None:
+            # the resumed start level did not finish in time, fall back to level 1
+            moveWinrates = self.root_winrates(state.copy(), empty_spots_left, interested_moves, player, 1)
+            self.level = 1
+        return moveWinrates
+
+    def single_move_winrate(self, state, empty_spots_left, current_move, player, level, state_hashes=None):
+        return self.run_search(self.single_move_search(state, empty_spots_left, current_move, player, level, state_hashes))
+
+    def single_move_search(self, state, empty_spots_left, current_move, player, level, state_hashes=None):
+        """ Generator version of single_move_winrate, see best_action_search """
+        if self.control.timed_out():
+            # checked for each root move too, even the ones known from the cache
+            raise SearchTimeout()
+        if state_hashes is None:
+            state_hashes = zobrist_hashes(state)
         # put the stone down
+        self.bitboard.sync(state)
         state[current_move[0], current_move[1]] = player
-        # check game ending conditions
-        # 1. i win (highest priority)
-        if i_win(state, current_move, player):
+        self.bitboard.place(current_move[0], current_move[1], player)
+        state_hashes = update_hashes(state_hashes, current_move[0], current_move[1], player, zobrist_table)
+        this_state_id = self.state_key(state_hashes)
+        # check game ending conditions: i win, i lost (only if I don't win) or i will win next round
+        result = self.bitboard.move_result(current_move[0], current_move[1], player)
+        if result != 0:
             # recover state
             state[current_move[0], current_move[1]] = 0
-            return 1.0
-        # 2. I lost, acccurate only if I don't win
-        elif i_lost(state, player):
-            # recover state
-            state[current_move[0], current_move[1]] = 0
-            return -1.0
-        # 3. I will win next round, only if I don't lose this round
-        elif i_will_win(state, current_move, player):
-            # recover state
-            state[current_move[0], current_move[1]] = 0
-            return 1.0
-        # check cache
-        this_state_id = state.tobytes()
-        q = self.cache.get(this_state_id, level)
+            self.bitboard.remove(current_move[0], current_move[1])
+            return float(result)
+        # check cache, the opponent is searched with level here
+        q = self.cache.get(this_state_id, level+1)
         if q is not None:
             # recover state
             state[current_move[0], current_move[1]] = 0
+            self.bitboard.remove(current_move[0], current_move[1])
             return q
         # known moves were handled already, here we evaluate opponents winrate
-        opponent_best_move, opponent_best_q = self.best_action_q(state, empty_spots_left-1, -2.0, 2.0, -player, level)
+        opponent_best_move, opponent_best_q, _ = yield from self.best_action_search(state, empty_spots_left-1, -2.0, 2.0, -player, level, state_hashes)
         # recover state
         state[current_move[0], current_move[1]] = 0
+        self.bitboard.remove(current_move[0], current_move[1])
         # my winrate is opposite of opponents
         return -opponent_best_q
 
@@ -143,7 +613,7 @@ class AIPlayer:
         return server_game_state
 
 
-    def best_action_q(self, state, empty_spots_left, alpha, beta, player, level):
+    def best_action_q(self, state, empty_spots_left, alpha, beta, player, level, state_hashes=None):
         """ 
         Get the optimal action for a state and the predicted win rate for player
 
@@ -159,6 +629,10 @@ class AIPlayer:
             Current beta value in alpha-beta pruning, the running max of the min win rate
         player: int
             The current player. 1 is black, -1 is white
+        level: int
+            How many more levels to search before evaluating with the dnn model
+        state_hashes: np.ndarray or None
+            Zobrist hashes of state for all symmetries, computed from state if not provided
 
         Returns
         -------
@@ -167,105 +641,266 @@ class AIPlayer:
         best_q: float or None
             The value the best move. 1.0 means 100% win, -1.0 means 100% lose, 0 means draw
         """
+        best_move, best_q, _ = self.run_search(self.best_action_search(state, empty_spots_left, alpha, beta, player, level, state_hashes))
+        return best_move, best_q
+
+    def best_action_search(self, state, empty_spots_left, alpha, beta, player, level, state_hashes=None, synced=False):
+        """
+        Generator version of best_action_q, the search is suspended at every dnn evaluation:
+        it yields the dnn inputs of the leaf positions, receives their values by send() and
+        finally returns (best_move, best_q, proven). Run it with run_search or run_batched_searches
+        proven is True if best_q does not depend on the dnn model: it is a proven win, or all the values
+        it came from were proven by the solvers or the ends of the game
+        synced is True inside the search, the interest map and the bitboard have followed its moves already
+        """
         if empty_spots_left == 0: # Board filled up, it's a tie
-            return (0,0), 0.0
+            return (0,0), 0.0, True
+        if self.control.timed_out():
+            raise SearchTimeout()
+        if state_hashes is None:
+            state_hashes = zobrist_hashes(state)
         verbose = False
         n_moves = 40 if empty_spots_left > 200 else 20
         self.move_interest_values.fill(0) # reuse the same array to save init cost
         self.move_interest_values[4:11, 4:11] = 5.0 # manually assign higher interest in middle
-        interested_moves = find_interesting_moves(state, empty_spots_left, self.move_interest_values, player, n_moves, verbose)
+        if not synced:
+            self.interest_map.sync(state)
+            self.bitboard.sync(state)
+        interested_moves = self.interest_map.find_interesting_moves(state, empty_spots_left, self.move_interest_values, player, n_moves, verbose)
+        if self.width_ratio is not None:
+            interested_moves = self.adaptive_width(interested_moves)
         #best_move = (-1,-1) # admit defeat if all moves have 0 win rate
         best_move = (interested_moves[0,0], interested_moves[0,1]) # continue to play even I'm losing
         # if there is only one move to place, directly return that move, use same level
         if len(interested_moves) == 1:
-            # check if this move is known
-            move, move_q, unknown_moves, unknown_move_ids = self.check_known(state, interested_moves, player, level)
+            # check if this move is known, it is searched with the same level
+            move, move_q, proven, unknown_moves, unknown_move_ids = self.check_known(state, state_hashes, interested_moves, player, level+1, alpha, beta)
             if move != None:
                 best_q = move_q
             else:
-                best_q = self.next_iter_winrate(state, empty_spots_left, best_move, alpha, beta, player, level)
-            return best_move, best_q
+                best_q, proven = yield from self.next_iter_search(state, empty_spots_left, best_move, alpha, beta, player, level, state_hashes)
+                self.cache.set(unknown_move_ids[0], best_q, level+1, search_bound(best_q, alpha, beta), proven)
+            return best_move, best_q, proven
         # if there are multiple moves to evaluate, check cache first
-        best_move, max_q, unknown_moves, unknown_move_ids = self.check_known(state, interested_moves, player, level)
+        # values of the moves will be computed with level-1 (cache level level), so accept cached values of the same quality
+        # at level 0 these are the dnn values
+        best_move, max_q, proven, unknown_moves, unknown_move_ids = self.check_known(state, state_hashes, interested_moves, player, max(level, 0), alpha, beta)
+        if max_q >= beta:
+            # fail-soft cutoff, a known move is already too good for the opponent to allow
+            return best_move, max_q, proven
+        if len(unknown_moves) > 0 and max_q < 1.0 and level <= 0:
+            # threat space pre-pass, a forced win by continuous fours needs no dnn evaluation
+            # above the leaves the search finds the win itself, the root is checked by solve_root_vcf
+            vcf_r, vcf_c = self.cached_vcf(state, state_hashes, player, VCF_MAX_NODES)
+            if vcf_r >= 0:
+                return (vcf_r, vcf_c), 1.0, True
         if len(unknown_moves) > 0:
             # for unknown moves, if level has reached, evaluate with DNN model
             if level <= 0:
-                dnn_q_array = self.dnn_evaluate(state, unknown_moves, player)
-                # store the values in cache
-                for move_id, dnn_q in zip(unknown_move_ids, dnn_q_array):
-                    self.cache.set(move_id, dnn_q, level)
-                # find the best move from tf results
-                dnn_best_move_idx = np.argmax(dnn_q_array)
-                dnn_max_q = dnn_q_array[dnn_best_move_idx]
-                # compare the tf results with cached results
-                if dnn_max_q > max_q:
-                    max_q = dnn_max_q
-                    best_move = unknown_moves[dnn_best_move_idx]
-            else:
-                # if level has not reached yet, go deeper to the next level
+                # moves that give the opponent a forced win are lost, they do not need the dnn
+                # moves that make a four are not quiet, the dnn is not reliable there, they are searched further
+                # a stone of mine can only block the fours of the opponent, so the moves are only checked one by one
+                # when the opponent has a forced win here already
+                opponent_threat = self.cached_vcf(state, state_hashes, -player, VCF_LEAF_MAX_NODES)[0] >= 0
+                dnn_moves = []
+                dnn_move_ids = []
+                forcing_moves = []
+                forcing_move_ids = []
                 for move, move_id in zip(unknown_moves, unknown_move_ids):
-                    q = self.next_iter_winrate(state, empty_spots_left, move, alpha, beta, player, level-1)
-                    # store the result in cache
-                    self.cache.set(move_id, q, level-1)
+                    state[move[0], move[1]] = player
+                    self.bitboard.place(move[0], move[1], player)
+                    opponent_vcf_r = -1
+                    if opponent_threat:
+                        opponent_vcf_r, _ = find_vcf(state, -player, VCF_MAX_DEPTH, VCF_LEAF_MAX_NODES)
+                    forcing = (self.quiescence_plies is not None and self.extended_plies < self.quiescence_plies
+                               and self.bitboard.n_five_points(player) > 0)
+                    state[move[0], move[1]] = 0
+                    self.bitboard.remove(move[0], move[1])
+                    if opponent_vcf_r >= 0:
+                        self.cache.set(move_id, -1.0, level, proven=True)
+                        if max_q < -1.0:
+                            max_q = -1.0
+                            best_move = move
+                    elif forcing:
+                        forcing_moves.append(move)
+                        forcing_move_ids.append(move_id)
+                    else:
+                        dnn_moves.append(move)
+                        dnn_move_ids.append(move_id)
+                if len(dnn_moves) > 0:
+                    proven = False
+                    dnn_q_array = yield self.dnn_inputs(state, dnn_moves, player)
+                    # store the values in cache, with level 0 below all searched values
+                    for move_id, dnn_q in zip(dnn_move_ids, dnn_q_array):
+                        self.cache.set(move_id, dnn_q, 0, proven=False)
+                    # find the best move from tf results
+                    dnn_best_move_idx = np.argmax(dnn_q_array)
+                    dnn_max_q = dnn_q_array[dnn_best_move_idx]
+                    # compare the tf results with cached results
+                    if dnn_max_q > max_q:
+                        max_q = dnn_max_q
+                        best_move = dnn_moves[dnn_best_move_idx]
+                # quiescence, after a four the opponent has to block, the search goes on at level 0 until quiet
+                alpha = max(alpha, max_q)
+                for move, move_id in zip(forcing_moves, forcing_move_ids):
+                    if max_q >= 1.0 or alpha >= beta:
+                        break
+                    self.extended_plies += 2
+                    try:
+                        q, q_proven = yield from self.next_iter_search(state, empty_spots_left, move, alpha, beta, player, level, state_hashes)
+                    finally:
+                        self.extended_plies -= 2
+                    self.cache.set(move_id, q, level+1, search_bound(q, alpha, beta), q_proven)
+                    proven = proven and q_proven
                     if q > max_q:
                         max_q = q
                         best_move = move
-                    if max_q >= 1.0:
-                        # early return
+                        alpha = max(alpha, max_q)
+                        if q >= 1.0:
+                            # a proven win is enough, whatever the other moves are worth
+                            proven = q_proven
+            else:
+                # if level has not reached yet, go deeper to the next level
+                alpha = max(alpha, max_q)
+                unknown_moves, unknown_move_ids = self.order_by_history(unknown_moves, unknown_move_ids, player, empty_spots_left)
+                unknown_moves, unknown_move_ids = self.order_by_cache(unknown_moves, unknown_move_ids)
+                best_searched_move = None
+                for i, (move, move_id) in enumerate(zip(unknown_moves, unknown_move_ids)):
+                    search_level = level-1
+                    if self.reduce_late_moves is not None and i >= self.reduce_late_moves and level >= 2:
+                        # late move reduction, a late move is searched one level shallower first,
+                        # and again with the full level only if it looks better than the best move so far
+                        q, q_proven = yield from self.next_iter_search(state, empty_spots_left, move, alpha, beta, player, level-2, state_hashes)
+                        if q > alpha:
+                            q, q_proven = yield from self.next_iter_search(state, empty_spots_left, move, alpha, beta, player, level-1, state_hashes)
+                        else:
+                            search_level = level-2
+                    else:
+                        q, q_proven = yield from self.next_iter_search(state, empty_spots_left, move, alpha, beta, player, level-1, state_hashes)
+                    # store the result in cache, it is only a bound if it fell outside of the window
+                    self.cache.set(move_id, q, search_level+1, search_bound(q, alpha, beta), q_proven)
+                    proven = proven and q_proven
+                    if q > max_q:
+                        max_q = q
+                        best_move = best_searched_move = move
+                        alpha = max(alpha, max_q)
+                        if q >= 1.0:
+                            proven = q_proven
+                    if max_q >= 1.0 or alpha >= beta:
+                        # early return, found a win or a beta cutoff
                         break
-        return best_move, max_q
+                if best_searched_move is not None:
+                    self.record_good_move(best_searched_move, player, level, empty_spots_left)
+        return best_move, max_q, proven
 
-    def next_iter_winrate(self, state, empty_spots_left, current_move, alpha, beta, player, level):
-        """Execute the step of the player, then return the winrate by computing next step"""
-        # update the stone down
+    def next_iter_search(self, state, empty_spots_left, current_move, alpha, beta, player, level, state_hashes):
+        """Execute the step of the player, then return the winrate by computing next step, and if it is proven"""
+        # update the stone down, and its hashes
         state[current_move[0], current_move[1]] = player
+        self.interest_map.place(current_move[0], current_move[1], player)
+        self.bitboard.place(current_move[0], current_move[1], player)
+        state_hashes = update_hashes(state_hashes, current_move[0], current_move[1], player, zobrist_table)
         # known moves were handled already, here we evaluate opponents winrate
-        opponent_best_move, opponent_best_q = self.best_action_q(state, empty_spots_left-1, alpha, beta, -player, level)
+        # the search window is flipped and negated for the opponent (negamax)
+        opponent_best_move, opponent_best_q, proven = yield from self.best_action_search(state, empty_spots_left-1, -beta, -alpha, -player, level, state_hashes, synced=True)
         # recover state
         state[current_move[0], current_move[1]] = 0
+        self.interest_map.remove(current_move[0], current_move[1])
+        self.bitboard.remove(current_move[0], current_move[1])
         # my winrate is opposite of opponents
-        return -opponent_best_q
+        return -opponent_best_q, proven
+
+    def adaptive_width(self, interested_moves):
+        """
+        Drop the moves with interest values far below the top move (width_ratio), they are rarely good
+        Keep at least ADAPTIVE_MIN_MOVES moves, and a single forced move as it is
+        """
+        if len(interested_moves) <= ADAPTIVE_MIN_MOVES:
+            return interested_moves
+        interest = self.move_interest_values[interested_moves[:,0], interested_moves[:,1]]
+        n_keep = max(ADAPTIVE_MIN_MOVES, int(np.sum(interest >= interest[0] * self.width_ratio)))
+        return interested_moves[:n_keep]
+
+    def order_by_history(self, moves, move_ids, player, empty_spots_left):
+        """
+        Sort the moves with the killer moves of this ply first, then by history score, ties keep their interest order
+        """
+        p = 0 if player == 1 else 1
+        killers = self.killers[empty_spots_left]
+        scores = [self.history[p, move[0], move[1]] for move in moves]
+        if len(killers) == 0 and not any(scores):
+            return moves, move_ids
+        for i, move in enumerate(moves):
+            if (move[0], move[1]) in killers:
+                scores[i] = np.inf
+        order = sorted(range(len(moves)), key=lambda i: scores[i], reverse=True)
+        return [moves[i] for i in order], [move_ids[i] for i in order]
+
+    def record_good_move(self, move, player, level, empty_spots_left):
+        """ Remember the best move of a search, or the one that cut it off, for the move ordering of later searches """
+        p = 0 if player == 1 else 1
+        # deeper searches are more reliable, and happen less often
+        self.history[p, move[0], move[1]] += level * level
+        killers = self.killers[empty_spots_left]
+        move = (int(move[0]), int(move[1]))
+        if move not in killers:
+            killers.insert(0, move)
+            del killers[2:]
+
+    def order_by_cache(self, moves, move_ids):
+        """
+        Sort the moves by values from earlier searches in cache (e.g. previous iterative deepening level), best first
+        Moves without cached values keep their interest order after them
+        """
+        prev_qs = [self.cache.peek(move_id) for move_id in move_ids]
+        if all(q is None for q in prev_qs):
+            return moves, move_ids
+        order = sorted(range(len(moves)), key=lambda i: -100 if prev_qs[i] is None else prev_qs[i], reverse=True)
+        return [moves[i] for i in order], [move_ids[i] for i in order]
+
+    def state_key(self, state_hashes):
+        """ Cache key of a state, the canonical key among its symmetries """
+        return canonical_key(state_hashes, self.n_symmetries)
 
-    def check_known(self, state, interested_moves, player, level):
+    def check_known(self, state, state_hashes, interested_moves, player, level, alpha=-2.0, beta=2.0):
         """
         Check which move in interested moves is known, using cache and ending condition
         When find_interested_moves only return 1 move, it might be a forced move (win or lose),
-        In this case, we will check ending condition i_win, i_lost or i_will_win
+        In this case, we will check the ending conditions with the bitboard: i win, i lost or i will win
+        Cached bounds are only used if they are decisive for the (alpha, beta) window
 
-        return (best_move, max_q, unknown_moves, unknown_move_ids)
+        return (best_move, max_q, proven, unknown_moves, unknown_move_ids)
         best_move, max_q are the best of the known moves among the interested_moves
+        proven is True if max_q is a proven win or all the known values are proven, see ArrayCache.get_entry
         unknown_moves, unknown_move_ids are for remaining unknown moves among the interested_moves
+        move ids are the canonical zobrist keys of the state after each move, updated from state_hashes
         """
         max_q = -100
         best_move = None
+        proven = True
         unknown_moves = []
         unknown_move_ids = []
+        move_ids = key_list(canonical_move_keys(state_hashes, interested_moves, player, self.n_symmetries, zobrist_table))
         if len(interested_moves) == 1:
             this_move = (interested_moves[0][0], interested_moves[0][1])
             assert state[this_move] == 0 # interest move should be empty here
             # put down this move
             state[this_move] = player
             # check if this state is cached
-            this_state_id = state.tobytes()
-            q = self.cache.get(this_state_id, level)
-            if q is not None:
+            this_state_id = move_ids[0]
+            entry = self.cache.get_entry(this_state_id, level, alpha, beta)
+            if entry is not None:
                 best_move = this_move
-                max_q = q
+                max_q, proven = entry
             else:
-                if i_win(state, this_move, player):
-                    best_move = this_move
-                    max_q = 1.0
-                    self.cache.set(this_state_id, max_q, level)
-                # 2. I lost, acccurate only if I don't win
-                elif i_lost(state, player):
-                    best_move = this_move
-                    max_q = -1.0
-                    self.cache.set(this_state_id, max_q, level)
-                # 3. I will win next round, only if I don't lose this round
-                elif i_will_win(state, this_move, player):
+                # i win, i lost (only if I don't win) or i will win next round
+                self.bitboard.place(this_move[0], this_move[1], player)
+                result = self.bitboard.move_result(this_move[0], this_move[1], player)
+                self.bitboard.remove(this_move[0], this_move[1])
+                if result != 0:
                     best_move = this_move
-                    max_q = 1.0
-                    self.cache.set(this_state_id, max_q, level)
+                    max_q = float(result)
+                    self.cache.set(this_state_id, max_q, level, proven=True)
                 else:
                     # q is not known for this move
                     unknown_moves.append(this_move)
@@ -273,60 +908,423 @@ class AIPlayer:
             # restore state 
             state[this_move] = 0
             # early return
-            return best_move, max_q, unknown_moves, unknown_move_ids
+            return best_move, max_q, proven, unknown_moves, unknown_move_ids
         # if reached here, means there are more than one interested moves
         # it means none of the moves are game-ending moves
-        for move in interested_moves:
+        for move, this_state_id in zip(interested_moves, move_ids):
             this_move = (move[0], move[1])
             assert state[this_move] == 0 # interest move should be empty here
-            # put down this move
-            state[this_move] = player
-            # compute cache key
-            this_state_id = state.tobytes()
             # check if its cached
-            q = self.cache.get(this_state_id, level)
-            if q is not None:
+            entry = self.cache.get_entry(this_state_id, level, alpha, beta)
+            if entry is not None:
+                q, q_proven = entry
                 # early return when found winning move
                 if q == 1.0:
-                    # restore state 
-                    state[this_move] = 0
                     # early return
                     best_move = this_move
                     max_q = 1.0
+                    proven = q_proven
                     unknown_moves = []
                     unknown_move_ids = []
                     break
+                proven = proven and q_proven
                 # compare with running max, update
-                elif q > max_q:
+                if q > max_q:
                     max_q = q
                     best_move = this_move
             else:
                 # q is not known
                 unknown_moves.append(this_move)
                 unknown_move_ids.append(this_state_id)
-            # restore state 
-            state[this_move] = 0
-        return best_move, max_q, unknown_moves, unknown_move_ids
+        return best_move, max_q, proven, unknown_moves, unknown_move_ids
 
     
     def dnn_evaluate(self, state, dnn_moves, player):
-        n_dnn = len(dnn_moves)
-        if n_dnn > 0:
-            all_interest_states = self.all_interest_states[:n_dnn] # we only need a slice of the big array
-            all_interest_states[:,0,:,:] = (state == player) # player's stones
-            all_interest_states[:,1,:,:] = (state == -player) # opponent stones
-            all_interest_states[:,2,:,:] = 1 if player == 1 else 0 # if player is black, set 1 else 0
-            for i,current_move in enumerate(dnn_moves):
-                ci, cj = current_move
-                all_interest_states[i,0,ci,cj] = 1 # put current move down
-            predict_y = self.model.predict(all_interest_states)
+        if len(dnn_moves) > 0:
+            predict_y = self.model.predict(self.dnn_inputs(state, dnn_moves, player))
             return predict_y.ravel()
         else:
             return []
 
+    def dnn_inputs(self, state, dnn_moves, player):
+        """ Prepare the dnn model inputs of the states after each of dnn_moves, in the reused scratch array """
+        n_dnn = len(dnn_moves)
+        all_interest_states = self.all_interest_states[:n_dnn] # we only need a slice of the big array
+        all_interest_states[:,0,:,:] = (state == player) # player's stones
+        all_interest_states[:,1,:,:] = (state == -player) # opponent stones
+        all_interest_states[:,2,:,:] = 1 if player == 1 else 0 # if player is black, set 1 else 0
+        for i,current_move in enumerate(dnn_moves):
+            ci, cj = current_move
+            all_interest_states[i,0,ci,cj] = 1 # put current move down
+        return all_interest_states
+
 # Below are utility functions
 
+# Zobrist hashing: a random key for each (player, position), the hash of a state is the xor of the keys of all stones
+# so it can be updated incrementally when a stone is placed or removed.
+# The hashes of all 8 symmetric images of the board (rotations and flips) are updated together,
+# the smallest one is the canonical key, so symmetric positions share the same cache entry.
+SYMMETRIES = 8
+CACHE_FLUSH_INTERVAL = 60 # seconds between writing the changes of a cache file to disk
+
+# cache levels: the dnn value of a leaf position is stored with level 0, the value of a position
+# searched with level L (the opponent to move searched by best_action_search with level L) with level L+1
+PONDER_REPLIES = 10 # most likely replies searched while the opponent is thinking
+PV_MAX_GAMES = 64 # principal variations kept for resuming the searches of that many recent predictions
+PN_UNSOLVED_POSITIONS = 1000 # positions the endgame solver could not solve are remembered, they are not tried again
+ADAPTIVE_MIN_MOVES = 5 # the adaptive width keeps at least this many moves
+VCF_CACHED_POSITIONS = 100000 # find_vcf results kept per player
+
+# the player of a root search worker process and the current search id of its pool, set by init_root_worker
+root_worker_player = None
+root_worker_search_ids = None
+
+def init_root_worker(model, n_symmetries, reduce_late_moves=None, width_ratio=None, quiescence_plies=None, cache_type=None, cache_name=None, search_ids=None):
+    """ Initialize a worker process of the root search pool, with the model, the shared cache and warmed up numba kernels """
+    global root_worker_player, root_worker_search_ids
+    root_worker_search_ids = search_ids
+    # the numba kernels are compiled with a search on a small throwaway cache, its positions never reach the real one
+    root_worker_player = AIPlayer("root worker", model=model, reduce_late_moves=reduce_late_moves, width_ratio=width_ratio,
+                                  quiescence_plies=quiescence_plies, cache=ArrayCache(maxsize=ARRAY_CACHE_SLOT_STEP))
+    root_worker_player.n_symmetries = n_symmetries
+    state = np.zeros(board_size**2, dtype=np.int8).reshape(board_size, board_size)
+    root_worker_player.single_move_winrate(state, board_size**2, (7, 7), 1, 0)
+    if cache_type is None:
+        root_worker_player.cache = ArrayCache(maxsize=2000000)
+    else:
+        # attach to the shared memory block or map the file of the cache
+        root_worker_player.cache = cache_type(cache_name)
+
+def root_worker_winrate(state, empty_spots_left, move, player, level, deadline, search_id):
+    """ Search a single root move in a worker process, return the winrate for player """
+    root_worker_player.control = WorkerControl(deadline, root_worker_search_ids, search_id)
+    return root_worker_player.single_move_winrate(state, empty_spots_left, move, player, level)
+
+def symmetric_position(r, c, sym):
+    """ Position of (r, c) after transforming the board with one of the 8 symmetries, 0 is identity """
+    n = board_size - 1
+    return ((r, c), (c, n-r), (n-r, n-c), (n-c, r), (r, n-c), (n-r, c), (c, r), (n-c, n-r))[sym]
+
+def build_zobrist_table(seed=15):
+    """
+    Build the zobrist keys indexed by [player, r, c, symmetry]
+    Players are indexed directly, 1 for black and -1 for white, 0 (empty) has no key
+    zobrist_table[p, r, c, s] is the key of a stone of player p at (r, c) on the board transformed by symmetry s
+    """
+    rng = np.random.default_rng(seed) # fixed seed so hashes are the same in every process
+    keys = np.zeros((3, board_size, board_size), dtype=np.uint64)
+    keys[1:] = rng.integers(0, 2**64, size=(2, board_size, board_size), dtype=np.uint64)
+    table = np.zeros((3, board_size, board_size, SYMMETRIES), dtype=np.uint64)
+    for sym in range(SYMMETRIES):
+        for r in range(board_size):
+            for c in range(board_size):
+                sr, sc = symmetric_position(r, c, sym)
+                table[:, r, c, sym] = keys[:, sr, sc]
+    return table
+
+zobrist_table = build_zobrist_table()
+
+def zobrist_hashes(state):
+    """ Compute the zobrist hashes of all symmetries of a state from scratch, shape (SYMMETRIES,) """
+    hashes = np.zeros(SYMMETRIES, dtype=np.uint64)
+    for r, c in zip(*np.nonzero(state)):
+        hashes ^= zobrist_table[state[r, c], r, c]
+    return hashes
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def update_hashes(hashes, r, c, player, zobrist_table):
+    """ Return the new hashes after a stone of player is placed (or removed) at (r, c) """
+    new_hashes = hashes.copy()
+    for sym in range(SYMMETRIES):
+        new_hashes[sym] ^= zobrist_table[player, r, c, sym]
+    return new_hashes
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def canonical_move_keys(hashes, moves, player, n_symmetries, zobrist_table):
+    """
+    Compute the canonical key of the state after each move, without placing the stones
+    The canonical key is the smallest hash among the first n_symmetries symmetries
+    """
+    n = len(moves)
+    keys = np.empty(n, dtype=np.uint64)
+    for i in range(n):
+        r = moves[i, 0]
+        c = moves[i, 1]
+        for sym in range(n_symmetries):
+            h = hashes[sym] ^ zobrist_table[player, r, c, sym]
+            if sym == 0 or h < keys[i]:
+                keys[i] = h
+    return keys
+
+def canonical_key(hashes, n_symmetries=SYMMETRIES):
+    """ Key of a state from its hashes, the smallest hash among the first n_symmetries symmetries """
+    return int(hashes[:n_symmetries].min())
+
+def key_list(keys):
+    """ Convert the keys from canonical_move_keys to python ints used by the cache """
+    return keys.tolist()
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def direction_interest(state, r, c, dr, dc, player):
+    """
+    Look at the line through the empty spot (r, c) in direction (dr, dc), the inner part of find_interesting_moves
+    Only the spots within distance 6 on the line are looked at
+    Return (peek_interest, line_interest, my_hard_4, my_five, opponent_five):
+    the interest from peeking over a gap, the interest from the line lengths, the number of my hard 4s,
+    if a stone here makes 5 for me and if it makes 5 for the opponent (so I have to block)
+    """
+    peek_interest = 0
+    line_interest = 0
+    my_hard_4 = 0
+    my_five = False
+    opponent_five = False
+    my_line_length = 1 # last_move
+    opponent_line_length = 1
+    # try to extend in the positive direction (max 5 times to check overline)
+    ext_r = r
+    ext_c = c
+    skipped_1 = 0
+    my_blocked = False
+    opponent_blocked = False
+    for i in range(5):
+        ext_r += dr
+        ext_c += dc
+        if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
+            break
+        elif state[ext_r, ext_c] == player:
+            if my_blocked == True:
+                break
+            else:
+                my_line_length += 1
+                opponent_blocked = True
+        elif state[ext_r, ext_c] == -player:
+            if opponent_blocked == True:
+                break
+            else:
+                opponent_line_length += 1
+                my_blocked = True
+        elif skipped_1 == 0:
+            skipped_1 = i + 1 # allow one skip and record the position of the skip
+        else:
+            # peek at the next one (if still on board) and if it might be useful, add some interest
+            if ext_r+dr < 0 or ext_r+dr >= board_size or ext_c+dc < 0 or ext_c+dc >= board_size:
+                break
+            if ((state[ext_r+dr, ext_c+dc] == player) and (my_blocked == False)) or ((state[ext_r+dr, ext_c+dc] == -player) and (opponent_blocked == False)):
+                peek_interest += 15
+            break
+
+    # the backward counting starts at the furthest "unskipped" stone
+    forward_my_open = False
+    forward_opponent_open = False
+    if skipped_1 == 0:
+        my_line_length_back = my_line_length
+        opponent_line_length_back = opponent_line_length
+    elif skipped_1 == 1:
+        my_line_length_back = 1
+        opponent_line_length_back = 1
+        forward_my_open = True
+        forward_opponent_open = True
+    else:
+        if my_blocked == False:
+            my_line_length_back = skipped_1
+            opponent_line_length_back = 1
+            forward_my_open = True
+        else:
+            my_line_length_back = 1
+            opponent_line_length_back = skipped_1
+            forward_opponent_open = True
+    my_line_length_no_skip = my_line_length_back
+    opponent_line_length_no_skip = opponent_line_length_back
+
+    # backward is a little complicated, will try to extend my stones first
+    ext_r = r
+    ext_c = c
+    skipped_2 = 0
+    opponent_blocked = False
+    for i in range(6-my_line_length_no_skip):
+        ext_r -= dr
+        ext_c -= dc
+        if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
+            break
+        elif state[ext_r, ext_c] == player:
+            my_line_length_back += 1
+            opponent_blocked = True
+        elif state[ext_r, ext_c] == -player:
+            break
+        else:
+            if skipped_2 == 0:
+                skipped_2 = i + 1
+            else:
+                # peek at the next one (if still on board) and if it might be useful, add some interest
+                if ext_r-dr < 0 or ext_r-dr >= board_size or ext_c-dc < 0 or ext_c-dc >= board_size:
+                    break
+                if state[ext_r-dr, ext_c-dc] == player:
+                    peek_interest += 15
+                break
+
+    # see if i'm winning
+    if my_line_length_back == 5:
+        # if there are 5 stones in backward counting, and it's not skipped in the middle
+        if skipped_2 == 0 or skipped_2 == (6-my_line_length_no_skip):
+            # i will win with this move
+            my_five = True
+
+    # extend my forward line length to check if there is hard 4
+    if skipped_2 == 0:
+        my_line_length += my_line_length_back - my_line_length_no_skip
+    else:
+        my_line_length += skipped_2 - 1
+
+    backward_my_open = True if skipped_2 > 0 else False
+    backward_opponent_open = False
+    # then try to extend the opponent
+    if opponent_blocked == True:
+        if skipped_2 == 1:
+            backward_opponent_open = True
+        skipped_2 = 0 # reset the skipped_2 here to enable the check of opponent 5 later
+    else:
+        ext_r = r
+        ext_c = c
+        skipped_2 = 0
+        for i in range(6-opponent_line_length_no_skip):
+            ext_r -= dr
+            ext_c -= dc
+            if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
+                break
+            elif state[ext_r, ext_c] == player:
+                break
+            elif state[ext_r, ext_c] == -player:
+                opponent_line_length_back += 1
+            else:
+                if skipped_2 == 0:
+                    skipped_2 = i + 1
+                else:
+                    # peek at the next one (if still on board) and if it might be useful, add some interest
+                    if ext_r-dr < 0 or ext_r-dr >= board_size or ext_c-dc < 0 or ext_c-dc >= board_size:
+                        break
+                    if state[ext_r-dr, ext_c-dc] == -player:
+                        peek_interest += 15
+                    break
+        # extend opponent forward line length to check if there is hard 4
+        if skipped_2 == 0:
+            opponent_line_length += opponent_line_length_back - opponent_line_length_no_skip
+        else:
+            opponent_line_length += skipped_2 - 1
+            backward_opponent_open = True
+            # here if opponent_line_length_back == 5, skipped_2 will be 0 and this flag won't be True
+            # but it do not affect our final result, because we have to block this no matter if it's open
+
+    # check if we have to block this
+    if opponent_line_length_back == 5:
+        if (skipped_2 == 0) or (skipped_2 == 6-opponent_line_length_no_skip):
+            opponent_five = True
+    # hard 4s, if I have 2 I will win after this move
+    if forward_my_open == True and my_line_length == 4:
+        my_hard_4 += 1
+    if backward_my_open == True and my_line_length_back == 4:
+        my_hard_4 += 1
+    # compute the interest_value for other moves
+    # if any line length >= 5, it's an overline so skipped
+    if (forward_my_open == True) and (my_line_length < 5):
+        line_interest += my_line_length ** 4
+    if (backward_my_open == True) and (my_line_length_back < 5):
+        line_interest += my_line_length_back ** 4
+    if (forward_opponent_open == True) and (opponent_line_length < 5):
+        line_interest += opponent_line_length ** 4
+    if (backward_opponent_open == True) and (opponent_line_length_back < 5):
+        line_interest += opponent_line_length_back ** 4
+    return peek_interest, line_interest, my_hard_4, my_five, opponent_five
+
+# direction_interest only depends on the 6 spots on each side of (r, c), each one empty, mine, opponent's
+# or off the board (only from the outside in), so all its results fit in a lookup table
+# the spots of one side are encoded as (3**n - 1) // 2 + code, n spots on the board and code their base 3 digits
+PATTERN_SIDES = (3**7 - 1) // 2 # 1093 encodings of one side
+PATTERN_TABLE_VERSION = 1 # increase when direction_interest changes, so the cached table on disk is rebuilt
+PATTERN_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), f'pattern_table_v{PATTERN_TABLE_VERSION}.npy')
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def build_pattern_table(table):
+    """
+    Fill table (PATTERN_SIDES**2) with the packed direction_interest results of every (backward, forward) side pair
+    Each pair is placed on the diagonal that has exactly n_back + 1 + n_forward spots, so the board ends right after them
+    """
+    state = np.zeros((board_size, board_size), dtype=np.int8)
+    for n_back in range(7):
+        for code_back in range(3**n_back):
+            for n_forward in range(7):
+                for code_forward in range(3**n_forward):
+                    length = n_back + 1 + n_forward
+                    c0 = board_size - length # the diagonal (0, c0) ... (length-1, board_size-1)
+                    x = code_back
+                    for k in range(1, n_back+1):
+                        state[n_back-k, c0+n_back-k] = 1 if x % 3 == 1 else -1 if x % 3 == 2 else 0
+                        x //= 3
+                    state[n_back, c0+n_back] = 0
+                    x = code_forward
+                    for k in range(1, n_forward+1):
+                        state[n_back+k, c0+n_back+k] = 1 if x % 3 == 1 else -1 if x % 3 == 2 else 0
+                        x //= 3
+                    peek_interest, line_interest, my_hard_4, my_five, opponent_five = direction_interest(state, n_back, c0+n_back, 1, 1, 1)
+                    idx = ((3**n_back - 1) // 2 + code_back) * PATTERN_SIDES + (3**n_forward - 1) // 2 + code_forward
+                    table[idx] = peek_interest | (line_interest << 8) | (my_hard_4 << 20) | (my_five << 22) | (opponent_five << 23)
+
+def load_pattern_table():
+    """ Load the pattern table cached on disk, or build it and try to save it for the next time """
+    try:
+        table = np.load(PATTERN_TABLE_PATH)
+        if table.shape == (PATTERN_SIDES**2,) and table.dtype == np.int32:
+            return table
+    except (OSError, ValueError):
+        pass
+    table = np.zeros(PATTERN_SIDES**2, dtype=np.int32)
+    build_pattern_table(table)
+    try:
+        # write to a temp file first, other processes may load the table at the same time
+        tmp_path = f'{PATTERN_TABLE_PATH}.{os.getpid()}.npy'
+        np.save(tmp_path, table)
+        os.replace(tmp_path, PATTERN_TABLE_PATH)
+    except OSError:
+        pass # read-only install, build again next time
+    return table
+
 @numba.jit(nopython=True, nogil=True, cache=True)
+def pattern_interest(state, r, c, dr, dc, player, table):
+    """ Same results as direction_interest(state, r, c, dr, dc, player), from the pattern table """
+    index = 0
+    for sign in (-1, 1):
+        code = 0
+        weight = 1
+        for k in range(1, 7):
+            ext_r = r + sign * k * dr
+            ext_c = c + sign * k * dc
+            if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
+                break
+            stone = state[ext_r, ext_c]
+            if stone == player:
+                code += weight
+            elif stone != 0:
+                code += 2 * weight
+            weight *= 3
+        index = index * PATTERN_SIDES + (weight - 1) // 2 + code
+    packed = table[index]
+    return packed & 0xFF, (packed >> 8) & 0xFFF, (packed >> 20) & 0x3, (packed >> 22) & 1, (packed >> 23) & 1
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def direction_values(state, player, values, table):
+    """ Fill values[r, c, direction] with the direction_interest results of all empty spots for player """
+    directions = ((1,1), (1,0), (0,1), (1,-1))
+    for r in range(board_size):
+        for c in range(board_size):
+            if state[r,c] != 0: continue
+            for d in range(4):
+                dr, dc = directions[d]
+                peek_interest, line_interest, my_hard_4, my_five, opponent_five = pattern_interest(state, r, c, dr, dc, player, table)
+                values[r, c, d, 0] = peek_interest
+                values[r, c, d, 1] = line_interest
+                values[r, c, d, 2] = my_hard_4
+                values[r, c, d, 3] = my_five
+                values[r, c, d, 4] = opponent_five
+
 def find_interesting_moves(state, empty_spots_left, move_interest_values, player, n_moves, verbose=False):
     """ Look at state and find the interesing n_move moves.
     input:
@@ -346,175 +1344,41 @@ def find_interesting_moves(state, empty_spots_left, move_interest_values, player
 
     #suggested_n_moves: suggested number of moves to
     """
+    values = np.zeros((board_size, board_size, 4, 5), dtype=np.int32)
+    direction_values(state, player, values, PATTERN_TABLE)
+    return interesting_moves_from_values(state, empty_spots_left, move_interest_values, n_moves, values, verbose)
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def interesting_moves_from_values(state, empty_spots_left, move_interest_values, n_moves, values, verbose=False):
+    """ Combine the direction values of each spot (see direction_values) into the result of find_interesting_moves """
     force_to_block = False
     exist_will_win_move = False
-    directions = ((1,1), (1,0), (0,1), (1,-1))
     final_single_move = np.zeros(2, dtype=np.int64).reshape(1,2) # for returning the single move
     for r in range(board_size):
         for c in range(board_size):
             if state[r,c] != 0: continue
             interest_value = 10 # as long as it's a valid point, this is for avoiding the taken spaces
             my_hard_4 = 0
-            for dr, dc in directions:
-                my_line_length = 1 # last_move
-                opponent_line_length = 1
-                # try to extend in the positive direction (max 5 times to check overline)
-                ext_r = r
-                ext_c = c
-                skipped_1 = 0
-                my_blocked = False
-                opponent_blocked = False
-                for i in range(5):
-                    ext_r += dr
-                    ext_c += dc
-                    if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
-                        break
-                    elif state[ext_r, ext_c] == player:
-                        if my_blocked == True:
-                            break
-                        else:
-                            my_line_length += 1
-                            opponent_blocked = True
-                    elif state[ext_r, ext_c] == -player:
-                        if opponent_blocked == True:
-                            break
-                        else:
-                            opponent_line_length += 1
-                            my_blocked = True
-                    elif skipped_1 == 0:
-                        skipped_1 = i + 1 # allow one skip and record the position of the skip
-                    else:
-                        # peek at the next one and if it might be useful, add some interest
-                        if ((state[ext_r+dr, ext_c+dc] == player) and (my_blocked == False)) or ((state[ext_r+dr, ext_c+dc] == -player) and (opponent_blocked == False)):
-                            interest_value += 15
-                        break
-
-                # the backward counting starts at the furthest "unskipped" stone
-                forward_my_open = False
-                forward_opponent_open = False
-                if skipped_1 == 0:
-                    my_line_length_back = my_line_length
-                    opponent_line_length_back = opponent_line_length
-                elif skipped_1 == 1:
-                    my_line_length_back = 1
-                    opponent_line_length_back = 1
-                    forward_my_open = True
-                    forward_opponent_open = True
-                else:
-                    if my_blocked == False:
-                        my_line_length_back = skipped_1
-                        opponent_line_length_back = 1
-                        forward_my_open = True
-                    else:
-                        my_line_length_back = 1
-                        opponent_line_length_back = skipped_1
-                        forward_opponent_open = True
-                my_line_length_no_skip = my_line_length_back
-                opponent_line_length_no_skip = opponent_line_length_back
-
-                # backward is a little complicated, will try to extend my stones first
-                ext_r = r
-                ext_c = c
-                skipped_2 = 0
-                opponent_blocked = False
-                for i in range(6-my_line_length_no_skip):
-                    ext_r -= dr
-                    ext_c -= dc
-                    if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
-                        break
-                    elif state[ext_r, ext_c] == player:
-                        my_line_length_back += 1
-                        opponent_blocked = True
-                    elif state[ext_r, ext_c] == -player:
-                        break
-                    else:
-                        if skipped_2 == 0:
-                            skipped_2 = i + 1
-                        else:
-                            # peek at the next one and if it might be useful, add some interest
-                            if state[ext_r-dr, ext_c-dc] == player:
-                                interest_value += 15
-                            break
-
-                # see if i'm winning
-                if my_line_length_back == 5:
-                    # if there are 5 stones in backward counting, and it's not skipped in the middle
-                    if skipped_2 == 0 or skipped_2 == (6-my_line_length_no_skip):
-                        # i will win with this move, I will place the stone
-                        final_single_move[0,0] = r
-                        final_single_move[0,1] = c
-                        return final_single_move
-
-                # extend my forward line length to check if there is hard 4
-                if skipped_2 == 0:
-                    my_line_length += my_line_length_back - my_line_length_no_skip
-                else:
-                    my_line_length += skipped_2 - 1
-
-                backward_my_open = True if skipped_2 > 0 else False
-                backward_opponent_open = False
-                # then try to extend the opponent
-                if opponent_blocked == True:
-                    if skipped_2 == 1:
-                        backward_opponent_open = True
-                    skipped_2 = 0 # reset the skipped_2 here to enable the check of opponent 5 later
-                else:
-                    ext_r = r
-                    ext_c = c
-                    skipped_2 = 0
-                    for i in range(6-opponent_line_length_no_skip):
-                        ext_r -= dr
-                        ext_c -= dc
-                        if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
-                            break
-                        elif state[ext_r, ext_c] == player:
-                            break
-                        elif state[ext_r, ext_c] == -player:
-                            opponent_line_length_back += 1
-                        else:
-                            if skipped_2 == 0:
-                                skipped_2 = i + 1
-                            else:
-                                # peek at the next one and if it might be useful, add some interest
-                                if state[ext_r-dr, ext_c-dc] == -player:
-                                    interest_value += 15
-                                break
-                    # extend opponent forward line length to check if there is hard 4
-                    if skipped_2 == 0:
-                        opponent_line_length += opponent_line_length_back - opponent_line_length_no_skip
-                    else:
-                        opponent_line_length += skipped_2 - 1
-                        backward_opponent_open = True
-                        # here if opponent_line_length_back == 5, skipped_2 will be 0 and this flag won't be True
-                        # but it do not affect our final result, because we have to block this no matter if it's open
-
-                # check if we have to block this
-                if opponent_line_length_back == 5:
-                    if (skipped_2 == 0) or (skipped_2 == 6-opponent_line_length_no_skip):
-                        final_single_move[0,0] = r
-                        final_single_move[0,1] = c
-                        force_to_block = True
+            for d in range(4):
+                interest_value += values[r, c, d, 0]
+                if values[r, c, d, 3]:
+                    # i will win with this move, I will place the stone
+                    final_single_move[0,0] = r
+                    final_single_move[0,1] = c
+                    return final_single_move
+                if values[r, c, d, 4]:
+                    final_single_move[0,0] = r
+                    final_single_move[0,1] = c
+                    force_to_block = True
                 if force_to_block == False:
                     # if I will win after this move, I won't consider other moves
-                    if forward_my_open == True and my_line_length == 4:
-                        my_hard_4 += 1
-                    if backward_my_open == True and my_line_length_back == 4:
-                        my_hard_4 += 1
+                    my_hard_4 += values[r, c, d, 2]
                     if my_hard_4 >= 2:
                         final_single_move[0,0] = r
                         final_single_move[0,1] = c
                         exist_will_win_move = True
                 if force_to_block == False and exist_will_win_move == False:
-                    # compute the interest_value for other moves
-                    # if any line length >= 5, it's an overline so skipped
-                    if (forward_my_open == True) and (my_line_length < 5):
-                        interest_value += my_line_length ** 4
-                    if (backward_my_open == True) and (my_line_length_back < 5):
-                        interest_value += my_line_length_back ** 4
-                    if (forward_opponent_open == True) and (opponent_line_length < 5):
-                        interest_value += opponent_line_length ** 4
-                    if (backward_opponent_open == True) and (opponent_line_length_back < 5):
-                        interest_value += opponent_line_length_back ** 4
+                    interest_value += values[r, c, d, 1]
             # after looking at all directions, record the total interest_value of this move
             move_interest_values[r, c] += interest_value
             if interest_value > 256: # one (length_4) ** 4, highly interesting move
@@ -542,6 +1406,104 @@ def find_interesting_moves(state, empty_spots_left, move_interest_values, player
                 print(interested_moves[i,0],interested_moves[i,1],'  :  ', flattened_interest[high_interest_idx[i]])
         return interested_moves
 
+@numba.jit(nopython=True, nogil=True, cache=True)
+def update_interest_map(board, state, values, table):
+    """
+    Bring the direction values of both players (values[0] for black, values[1] for white) from board to state
+    Only the spots on the 4 lines within distance 6 of a changed stone are recomputed, that is all
+    direction_interest looks at. Rebuild everything if too many stones changed. Return the number of changed spots
+    """
+    directions = ((1,1), (1,0), (0,1), (1,-1))
+    n_changed = 0
+    for r in range(board_size):
+        for c in range(board_size):
+            if board[r,c] != state[r,c]:
+                n_changed += 1
+    if n_changed == 0:
+        return 0
+    stale = np.zeros((board_size, board_size, 4), dtype=np.bool_)
+    if n_changed > 16:
+        # each changed spot costs 13 spots x 4 directions, more than checking the whole board
+        stale[:] = True
+    else:
+        for r in range(board_size):
+            for c in range(board_size):
+                if board[r,c] == state[r,c]: continue
+                for d in range(4):
+                    dr, dc = directions[d]
+                    for k in range(-6, 7):
+                        sr = r + k * dr
+                        sc = c + k * dc
+                        if 0 <= sr < board_size and 0 <= sc < board_size:
+                            stale[sr, sc, d] = True
+    board[:] = state
+    for r in range(board_size):
+        for c in range(board_size):
+            # the values of taken spots are never used
+            if state[r,c] != 0: continue
+            for d in range(4):
+                if not stale[r, c, d]: continue
+                dr, dc = directions[d]
+                for p in range(2):
+                    peek_interest, line_interest, my_hard_4, my_five, opponent_five = pattern_interest(state, r, c, dr, dc, 1 - 2*p, table)
+                    values[p, r, c, d, 0] = peek_interest
+                    values[p, r, c, d, 1] = line_interest
+                    values[p, r, c, d, 2] = my_hard_4
+                    values[p, r, c, d, 3] = my_five
+                    values[p, r, c, d, 4] = opponent_five
+    return n_changed
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def move_interest_map(board, values, table, r, c, stone):
+    """
+    Put stone (0 to take it back) at (r, c) of board and recompute the direction values of both players
+    on the 4 lines within distance 6 of it, the same spots update_interest_map recomputes for one changed stone
+    """
+    directions = ((1,1), (1,0), (0,1), (1,-1))
+    board[r, c] = stone
+    for d in range(4):
+        dr, dc = directions[d]
+        for k in range(-6, 7):
+            sr = r + k * dr
+            sc = c + k * dc
+            # the values of taken spots are never used
+            if sr < 0 or sr >= board_size or sc < 0 or sc >= board_size or board[sr, sc] != 0:
+                continue
+            for p in range(2):
+                peek_interest, line_interest, my_hard_4, my_five, opponent_five = pattern_interest(board, sr, sc, dr, dc, 1 - 2*p, table)
+                values[p, sr, sc, d, 0] = peek_interest
+                values[p, sr, sc, d, 1] = line_interest
+                values[p, sr, sc, d, 2] = my_hard_4
+                values[p, sr, sc, d, 3] = my_five
+                values[p, sr, sc, d, 4] = opponent_five
+
+PATTERN_TABLE = load_pattern_table()
+
+class InterestMap:
+    """
+    Keeps the direction values of find_interesting_moves for both players on its board
+    The search places and removes each stone on the map too, so only the lines through that stone are recomputed
+    The map is synced with the whole board at the first position of a search, or after a search was stopped
+    """
+
+    def __init__(self):
+        self.board = np.full((board_size, board_size), 2, dtype=np.int8) # not a stone, the first sync rebuilds all values
+        self.values = np.zeros((2, board_size, board_size, 4, 5), dtype=np.int32)
+
+    def sync(self, state):
+        """ Bring the map to state by comparing the whole board """
+        update_interest_map(self.board, state, self.values, PATTERN_TABLE)
+
+    def place(self, r, c, player):
+        move_interest_map(self.board, self.values, PATTERN_TABLE, r, c, player)
+
+    def remove(self, r, c):
+        move_interest_map(self.board, self.values, PATTERN_TABLE, r, c, 0)
+
+    def find_interesting_moves(self, state, empty_spots_left, move_interest_values, player, n_moves, verbose=False):
+        """ Same as find_interesting_moves(state, ...), the map has to be in sync with state """
+        return interesting_moves_from_values(state, empty_spots_left, move_interest_values, n_moves, self.values[0 if player == 1 else 1], verbose)
+
 @numba.jit(nopython=True, nogil=True)
 def i_win(state, last_move, player):
     """ Return true if I just got 5-in-a-row with last_move """
@@ -578,94 +1540,6 @@ def i_win(state, last_move, player):
             return True # 5 in a row
     return False
 
-@numba.jit(nopython=True, nogil=True)
-def i_lost(state, player):
-    for r in range(board_size):
-        for c in range(board_size):
-            if state[r,c] == 0 and i_win(state, (r,c), -player):
-                return True
-    return False
-
-@numba.jit(nopython=True, nogil=True)
-def i_will_win(state, last_move, player):
-    """ Return true if I will win next step if the opponent don't have 4-in-a-row.
-    Winning Conditions:
-        1. 5 in a row.
-        2. 4 in a row with both end open. (free 4)
-        3. 4 in a row with one missing stone x 2 (hard 4 x 2)
-     """
-    r, c = last_move
-    # try all 4 directions, the other 4 is equivalent
-    directions = [(1,1), (1,0), (0,1), (1,-1)]
-    n_hard_4 = 0 # number of hard 4s found
-    for dr, dc in directions:
-        line_length = 1 # last_move
-        # try to extend in the positive direction (max 5 times to check overline)
-        ext_r = r
-        ext_c = c
-        skipped_1 = 0
-        for i in range(5):
-            ext_r += dr
-            ext_c += dc
-            if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
-                break
-            elif state[ext_r, ext_c] == player:
-                line_length += 1
-            elif skipped_1 == 0 and state[ext_r, ext_c] == 0:
-                skipped_1 = i+1 # allow one skip and record the position of the skip
-            else:
-                break
-        # try to extend in the opposite direction
-        ext_r = r
-        ext_c = c
-        skipped_2 = 0
-        # the backward counting starts at the furthest "unskipped" stone
-        if skipped_1 != 0:
-            line_length_back = skipped_1
-        else:
-            line_length_back = line_length
-        line_length_no_skip = line_length_back
-        for i in range(6-line_length_back):
-            ext_r -= dr
-            ext_c -= dc
-            if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
-                break
-            elif state[ext_r, ext_c] == player:
-                line_length_back += 1
-            elif skipped_2 == 0 and state[ext_r, ext_c] == 0:
-                skipped_2 = i + 1
-            else:
-                break
-
-        if line_length_back == 6:
-            # we found 6 stones in a row, this is overline, skip this entire line
-            continue
-        elif line_length_back == 5:
-            if (skipped_2 == 0) or (skipped_2 == (6-line_length_no_skip)):
-                # we found 5 stones in a row, because the backward counting is not skipped in the middle
-                return True
-                # else there is an empty spot in the middle of 6 stones, it's not a hard 4 any more
-        elif line_length_back == 4:
-            # here we have only 4 stones, if skipped in back count, it's a hard 4
-            if skipped_2 != 0:
-                n_hard_4 += 1 # backward hard 4
-                if n_hard_4 == 2:
-                    return True # two hard 4
-        # here we check if there's a hard 4 in the forward direction
-        # extend the forward line to the furthest "unskipped" stone
-        if skipped_2 == 0:
-            line_length += line_length_back - line_length_no_skip
-        else:
-            line_length += skipped_2 - 1
-        # hard 4 only if forward length is 4, if forward reaches 5 or more, it's going to be overline
-        if line_length == 4 and skipped_1 != 0:
-            n_hard_4 += 1 # forward hard 4
-            if n_hard_4 == 2:
-                return True # two hard 4 or free 4
-    return False
-
-
-
 from collections import OrderedDict
 class LRU(OrderedDict):
     'Limit size, evicting the least recently looked-up key when full'
@@ -687,64 +1561,334 @@ class LRU(OrderedDict):
             oldest = next(iter(self))
             del self[oldest]
 
-class LeveledCache:
+# bound types of cached values, values from a cutoff search are only bounds of the true value
+BOUND_EXACT = 0
+BOUND_LOWER = 1 # true value >= cached value
+BOUND_UPPER = 2 # true value <= cached value
+
+def search_bound(q, alpha, beta):
+    """ Classify the fail-soft result q of a search with window (alpha, beta) """
+    if q >= 1.0 or q <= -1.0:
+        # a proven win or lose can not be improved
+        return BOUND_EXACT
+    elif q <= alpha:
+        return BOUND_UPPER
+    elif q >= beta:
+        return BOUND_LOWER
+    return BOUND_EXACT
+
+ARRAY_CACHE_SLOT_STEP = 256 # the number of slots of an array table is a multiple of this, so the table is whole 4kB pages
+
+def array_cache_slots(maxsize, max_bytes=None):
     """
-    Cache with level system, level 0 has lowest quality, maxlevel has highest quality thus takes priority
-    When maxsize reached, oldest key from lowest cache will be deleted
+    Number of slots of an array table, for at least maxsize entries or at most max_bytes bytes (16 bytes per slot),
+    the 16 bytes of the header (age and model) are counted in max_bytes too. The smallest table has ARRAY_CACHE_SLOT_STEP slots
     """
+    if max_bytes is not None:
+        n_slots = (max_bytes - 16) // 16 // ARRAY_CACHE_SLOT_STEP * ARRAY_CACHE_SLOT_STEP
+    else:
+        n_slots = -(-maxsize // ARRAY_CACHE_SLOT_STEP) * ARRAY_CACHE_SLOT_STEP
+    return max(n_slots, ARRAY_CACHE_SLOT_STEP)
 
-    def __init__(self, maxsize=128):
-        self.maxlevel = 0 # dynamically adjusted based on set
-        self.maxsize = maxsize
-        self.caches = [OrderedDict() for _ in range(self.maxlevel+1)]
-        self.size = 0
-    
-    def get(self, key, min_accepted_level):
+@numba.jit(nopython=True, nogil=True, cache=True)
+def array_cache_current(data, model):
+    """ Return true if the entry data is proven (model 0) or from model, the values of older models are stale """
+    entry_model = np.int64((data >> np.uint64(50)) & np.uint64(0x3F))
+    return entry_model == 0 or entry_model == model
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def array_cache_lookup(checks, datas, key, min_level, alpha, beta, any_bound, model):
+    """
+    Find the highest level entry of key in its bucket that has level >= min_level and is usable in (alpha, beta),
+    or with any bound if any_bound. Entries of other models than model are skipped. Return (found, value, proven)
+    """
+    slot = (key % np.uint64(len(datas) // 2)) * np.uint64(2)
+    found = False
+    best_level = -1
+    best_value = 0.0
+    best_proven = False
+    for s in range(slot, slot+np.uint64(2)):
+        data = datas[s]
+        # an entry torn by a concurrent write fails this check
+        if data == 0 or checks[s] ^ data != key or not array_cache_current(data, model):
+            continue
+        level = np.int64((data >> np.uint64(32)) & np.uint64(0xFFFF)) - 1
+        bound = np.int64((data >> np.uint64(48)) & np.uint64(0x3))
+        value = np.float64(np.array([data & np.uint64(0xFFFFFFFF)]).astype(np.uint32).view(np.float32)[0])
+        if level < min_level or level <= best_level:
+            continue
+        if any_bound or bound == BOUND_EXACT or (bound == BOUND_LOWER and value >= beta) or (bound == BOUND_UPPER and value <= alpha):
+            found = True
+            best_level = level
+            best_value = value
+            best_proven = (data >> np.uint64(50)) & np.uint64(0x3F) == 0
+    return found, best_value, best_proven
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def array_cache_store(checks, datas, key, value, level, bound, age, model, proven):
+    """
+    Store an entry of key in its bucket. An entry of the same key is replaced unless it has higher level,
+    or is exact at the same level while the new one is a bound (a higher level bound goes to the other slot
+    so both are kept). A new key takes the first slot if its level is at least as high or the entry there
+    is from an older search (age) or model, pushing the old entry to the second slot, otherwise it replaces the second slot
+    The entry is tagged with model, or with 0 if proven, then it holds for any model
+    """
+    slot = (key % np.uint64(len(datas) // 2)) * np.uint64(2)
+    level = max(level, 0)
+    value_bits = np.array([value], dtype=np.float32).view(np.uint32)[0]
+    new_data = (np.uint64(value_bits) | (np.uint64(level + 1) << np.uint64(32)) | (np.uint64(bound) << np.uint64(48))
+                | (np.uint64(0 if proven else model) << np.uint64(50)) | (np.uint64(age) << np.uint64(56)))
+    for s in range(slot, slot+np.uint64(2)):
+        data = datas[s]
+        if data != 0 and checks[s] ^ data == key and array_cache_current(data, model):
+            old_level = np.int64((data >> np.uint64(32)) & np.uint64(0xFFFF)) - 1
+            old_bound = np.int64((data >> np.uint64(48)) & np.uint64(0x3))
+            if level < old_level or (level == old_level and bound != BOUND_EXACT and old_bound == BOUND_EXACT):
+                return
+            if bound != BOUND_EXACT and old_bound == BOUND_EXACT:
+                # keep the exact value of the lower level too
+                s = slot + (s - slot + np.uint64(1)) % np.uint64(2)
+            datas[s] = new_data
+            checks[s] = key ^ new_data
+            return
+    data = datas[slot]
+    if (data == 0 or level >= np.int64((data >> np.uint64(32)) & np.uint64(0xFFFF)) - 1
+            or np.int64(data >> np.uint64(56)) != age or not array_cache_current(data, model)):
+        datas[slot+np.uint64(1)] = data
+        checks[slot+np.uint64(1)] = checks[slot]
+        s = slot
+    else:
+        s = slot + np.uint64(1)
+    datas[s] = new_data
+    checks[s] = key ^ new_data
+
+class ArrayCache:
+    """
+    Fixed size transposition table in numpy arrays, 16 bytes per entry, can be shared by threads without locks
+    Each bucket has two entries, one kept for higher levels and one always replaced
+    An entry is stored as (key ^ data, data) in two words, so an entry torn by a concurrent write fails the key check
+    The data word packs the value as float32, the level, the bound type, the model and the age
+    The age is bumped by new_search, entries of older searches give way to new ones even at lower levels
+    The model is bumped by new_model, the proven wins and losses are stored with model 0 and kept for all models
+    """
+
+    def __init__(self, maxsize=128, max_bytes=None):
+        n_slots = array_cache_slots(maxsize, max_bytes)
+        self.maxsize = n_slots
+        self.checks = np.zeros(n_slots, dtype=np.uint64)
+        self.datas = np.zeros(n_slots, dtype=np.uint64)
+        self.header = np.ones(2, dtype=np.uint64) # the age and the model, next to the table for the shared and mapped tables
+        self.digest = None # model_digest of the weights the values are from, set by AIPlayer.reset_cache
+
+    @property
+    def age(self):
+        return int(self.header[0])
+
+    def new_search(self):
+        """ Start a new search, the entries stored so far get older """
+        self.header[0] = self.age % 255 + 1
+
+    def get(self, key, min_accepted_level, alpha=-2.0, beta=2.0):
         """
-        Go over each level in cache, find one value with key
+        Find the highest level value of key with level >= min_accepted_level that is usable in the (alpha, beta) window
+        Exact values are always usable, lower bounds only when >= beta, upper bounds only when <= alpha
         If none found, return None
         """
-        for level in range(self.maxlevel, max(min_accepted_level,0)-1, -1):
-            # starting from higest level, look for cached value
-            cache = self.caches[level]
+        entry = self.get_entry(key, min_accepted_level, alpha, beta)
+        return None if entry is None else entry[0]
+
+    def get_entry(self, key, min_accepted_level, alpha=-2.0, beta=2.0):
+        """ Same as get, but return (value, proven) or None, proven values were stored by a solver and hold for any model """
+        found, value, proven = array_cache_lookup(self.checks, self.datas, np.uint64(key), min_accepted_level, alpha, beta, False, self.model)
+        return (value, proven) if found else None
+
+    def peek(self, key):
+        """ Return the value of key from the highest level regardless of its bound, used for move ordering """
+        found, value, _ = array_cache_lookup(self.checks, self.datas, np.uint64(key), 0, -2.0, 2.0, True, self.model)
+        return value if found else None
+
+    def set(self, key, value, level, bound=BOUND_EXACT, proven=False):
+        """
+        set a value in cache with level and bound type
+        proven values come from the solvers or only from other proven values, they do not depend on the model
+        """
+        array_cache_store(self.checks, self.datas, np.uint64(key), value, level, bound, self.age, self.model, proven)
+
+    @property
+    def model(self):
+        return int(self.header[1])
+
+    @property
+    def nbytes(self):
+        """ Bytes of the table, it has a fixed size """
+        return self.header.nbytes + self.checks.nbytes + self.datas.nbytes
+
+    def usage(self):
+        """
+        Bytes taken by the entries of each level that are still used (proven or of the current model), by level
+        It scans the whole table, for tests and stats only, not for the searches
+        """
+        datas = self.datas
+        models = (datas >> np.uint64(50)) & np.uint64(0x3F)
+        used = datas[(datas != 0) & ((models == 0) | (models == self.model))]
+        levels = ((used >> np.uint64(32)) & np.uint64(0xFFFF)).astype(np.int64) - 1
+        return {level: 16 * int(n) for level, n in enumerate(np.bincount(levels)) if n > 0}
+
+    def new_model(self):
+        """
+        Switch to a new model, the values of the old model are no longer used and get replaced as the search goes,
+        the proven values are kept. The model number is 6 bits, the entries left from the last model with
+        the new number (63 models ago) are removed right away
+        """
+        model = self.model % 63 + 1
+        stale = ((self.datas >> np.uint64(50)) & np.uint64(0x3F)) == model
+        self.datas[stale] = 0
+        self.checks[stale] = 0
+        self.header[1] = model
+
+def model_digest(model):
+    """ Short hash of the model weights, processes with the same weights get the same digest """
+    h = hashlib.sha1()
+    if hasattr(model, 'state_dict'):
+        for name, weights in model.state_dict().items():
+            h.update(name.encode())
+            h.update(weights.detach().cpu().numpy().tobytes())
+    else:
+        h.update(pickle.dumps(model))
+    # shared memory names are limited to 30 characters on macos
+    return h.hexdigest()[:8]
+
+def attach_shared_memory(name):
+    """
+    Attach to an existing block of shared memory without registering it with the resource tracker,
+    which would remove the block when this process exits (track=False from python 3.13)
+    """
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+class SharedArrayCache(ArrayCache):
+    """
+    ArrayCache in a block of shared memory, so that processes on the same host search with one table
+    The first process opening a name creates the block and the others attach to it, name None creates a new block
+    The processes write without locks like the threads of ArrayCache, the age and the model are kept in the block too
+    so the processes sharing a block should search with the same model, AIPlayer tags the name with its weights
+    The creator removes the block on close, or when it exits
+    """
+
+    def __init__(self, name=None, maxsize=128, max_bytes=None):
+        n_slots = array_cache_slots(maxsize, max_bytes)
+        try:
+            # two words for the age and the model, then the checks and the datas
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=16 + 16*n_slots)
+            self.owner = True
+        except FileExistsError:
+            self.shm = attach_shared_memory(name)
+            self.owner = False
+            # the size of the existing block decides, the block can be rounded up to whole pages
+            n_slots = (self.shm.size - 16) // 16 // ARRAY_CACHE_SLOT_STEP * ARRAY_CACHE_SLOT_STEP
+        self.name = self.shm.name
+        self.maxsize = n_slots
+        self.digest = None
+        self.header = np.ndarray(2, dtype=np.uint64, buffer=self.shm.buf)
+        self.checks = np.ndarray(n_slots, dtype=np.uint64, buffer=self.shm.buf, offset=16)
+        self.datas = np.ndarray(n_slots, dtype=np.uint64, buffer=self.shm.buf, offset=16 + 8*n_slots)
+        if self.owner:
+            self.header[:] = 1
+            # otherwise the block is left behind, and reported as leaked by the resource tracker
+            atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ Detach from the block, the creator also removes it (processes still attached keep using it) """
+        if self.shm is None:
+            return
+        self.header = self.checks = self.datas = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+            atexit.unregister(self.close)
+        self.shm = None
+
+class MappedArrayCache(ArrayCache):
+    """
+    ArrayCache in a memory mapped file, the table survives restarts and the processes mapping the file share it
+    Nothing is read at start, the pages are loaded when the search first touches them and written back by flush,
+    in a background thread every flush_interval seconds if set, and by close, also called at exit
+    The values depend on the model, the file should be tagged with it, e.g. with its content hash in the name
+    """
+
+    def __init__(self, path, maxsize=128, flush_interval=None, max_bytes=None):
+        n_slots = array_cache_slots(maxsize, max_bytes)
+        # the file is made full size with its header under a temporary name and linked in place, another process opening
+        # the path sees the whole table or no file at all
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
             try:
-                result = cache[key]
-                cache.move_to_end(key)
-                return result
-            except KeyError:
-                pass
-        return None
-        
-    def set(self, key, value, level):
-        """
-        set a value in cache with level
-        """
-        if level > self.maxlevel:
-            # increase max level dynamically
-            n_new_levels = level - self.maxlevel
-            self.caches += [OrderedDict() for _ in range(n_new_levels)]
-            self.maxlevel = level
-        # delete oldest from lowest cache if size reached
-        if self.size >= self.maxsize:
-            for l in range(self.maxlevel):
-                cache = self.caches[l]
-                try:
-                    oldest = next(iter(cache))
-                    del cache[oldest]
-                    break
-                except StopIteration:
-                    # if cache is empty skip and go to the next level cache
-                    pass
-        else:
-            # update size
-            self.size += 1
-        # insert new key
-        cache = self.caches[level]
-        # move key to end
-        if key in cache:
-            cache.move_to_end(key)
-        # set the value
-        cache[key] = value
+                # two words for the age and the model, then the checks and the datas
+                os.write(fd, np.ones(2, dtype=np.uint64).tobytes())
+                os.ftruncate(fd, 16 + 16*n_slots)
+            finally:
+                os.close(fd)
+            os.link(tmp_path, path)
+        except FileExistsError:
+            # the size of the existing file decides
+            n_slots = (os.path.getsize(path) - 16) // 16 // ARRAY_CACHE_SLOT_STEP * ARRAY_CACHE_SLOT_STEP
+            if n_slots <= 0:
+                raise ValueError(f"{path} is too short for a cache file")
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        self.name = path
+        self.maxsize = n_slots
+        self.digest = None
+        self.mmap = np.memmap(path, dtype=np.uint64, mode='r+', shape=(2 + 2*n_slots,))
+        self.header = self.mmap[:2]
+        self.checks = self.mmap[2:2+n_slots]
+        self.datas = self.mmap[2+n_slots:]
+        self.stop_flushing = threading.Event()
+        self.flush_thread = None
+        if flush_interval is not None:
+            self.flush_thread = threading.Thread(target=self.flush_every, args=(flush_interval,), daemon=True)
+            self.flush_thread.start()
+        # otherwise the changes since the last flush are lost
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def flush(self):
+        """ Write the changed pages to the file """
+        self.mmap.flush()
+
+    def flush_every(self, interval):
+        while not self.stop_flushing.wait(interval):
+            self.flush()
+
+    def close(self):
+        """ Stop the flush thread, write the last changes and unmap the file """
+        if self.mmap is None:
+            return
+        self.stop_flushing.set()
+        if self.flush_thread is not None:
+            self.flush_thread.join()
+            self.flush_thread = None
+        self.flush()
+        self.header = self.checks = self.datas = None
+        self.mmap = None
+        atexit.unregister(self.close)
 
 def show_state(state):
     board_size = 15
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+import time
+import numpy as np
+
+from gomoku_ai.ai_player import board_size, find_interesting_moves, i_win
+
+class MCTSNode:
+    """ A searched position, keeps the visit counts and value sums of its candidate moves """
+
+    def __init__(self, moves, priors):
+        self.moves = moves
+        self.priors = priors
+        self.visits = np.zeros(len(moves), dtype=np.float32)
+        self.value_sums = np.zeros(len(moves), dtype=np.float32) # from the view of the player to move here
+        self.children = [None] * len(moves) # MCTSNode once expanded, or the final value of a move that ends the game
+
+    def select(self, c_puct):
+        """ Pick the move with highest PUCT score, unvisited moves count as a draw """
+        q = np.divide(self.value_sums, self.visits, out=np.zeros_like(self.value_sums), where=self.visits > 0)
+        u = c_puct * self.priors * np.sqrt(self.visits.sum() + 1) / (1 + self.visits)
+        return int(np.argmax(q + u))
+
+class MCTS:
+    """
+    Monte Carlo tree search with PUCT, the interest values of find_interesting_moves are used as priors
+    and the dnn model as value function. Playouts are run in batches with virtual loss so their leaves
+    can be evaluated with one model call. The tree is kept and reused for the next moves of the game.
+    """
+
+    def __init__(self, model, n_moves=40, c_puct=1.5, batch_size=16):
+        self.model = model
+        self.n_moves = n_moves # number of candidate moves in each node
+        self.c_puct = c_puct # weight of the priors against the values
+        self.batch_size = batch_size # playouts per model call
+        self.all_interest_states = np.zeros(batch_size * 3 * board_size**2, dtype=np.float32).reshape(batch_size, 3, board_size, board_size)
+        self.move_interest_values = np.zeros(board_size**2, dtype=np.float32).reshape(board_size,board_size)
+        self.reset()
+
+    def reset(self):
+        """ Drop the search tree """
+        self.root = None
+        self.root_history = None
+
+    def search(self, state, empty_spots_left, player, move_history, n_playouts=800, time_limit=None):
+        """
+        Run playouts from state until n_playouts are done, or time_limit (seconds) is used up if given
+        move_history is the list of moves [r, c, ...] leading to state, used to find the reusable part of the tree
+        Return the moveWinrates list of the root moves, most visited first
+        """
+        t_start = time.time()
+        history = [(int(m[0]), int(m[1])) for m in move_history]
+        root = self.reuse_tree(history)
+        if root is None:
+            root = self.expand(state, empty_spots_left, player, root=True)
+        self.root = root
+        self.root_history = history
+        state = state.copy()
+        n_done = 0
+        while n_done == 0 or (time.time() - t_start < time_limit if time_limit is not None else n_done < n_playouts):
+            n_done += self.run_batch(root, state, empty_spots_left, player)
+        print(f"MCTS ran {n_done} playouts in {time.time() - t_start:.2f}s, {int(root.visits.sum())} in tree")
+
+        moveWinrates = []
+        for i in np.argsort(-root.visits, kind='stable'):
+            if root.visits[i] == 0:
+                continue
+            q = root.value_sums[i] / root.visits[i]
+            moveWinrates.append([int(root.moves[i,0]), int(root.moves[i,1]), float(q*0.5+0.5)])
+        return moveWinrates
+
+    def reuse_tree(self, history):
+        """ Return the node of the current tree reached by the moves played since the last search, or None """
+        if self.root is None or history[:len(self.root_history)] != self.root_history:
+            return None
+        node = self.root
+        for r, c in history[len(self.root_history):]:
+            idx = np.flatnonzero((node.moves[:,0] == r) & (node.moves[:,1] == c))
+            if len(idx) == 0 or not isinstance(node.children[idx[0]], MCTSNode):
+                return None
+            node = node.children[idx[0]]
+        return node
+
+    def expand(self, state, empty_spots_left, player, root=False):
+        """ Create the node of state with player to move, priors are the normalized interest values """
+        self.move_interest_values.fill(0)
+        if root:
+            self.move_interest_values[4:11, 4:11] = 5.0 # same as AIPlayer.predict, higher interest in middle
+        moves = find_interesting_moves(state, empty_spots_left, self.move_interest_values, player, self.n_moves, False)
+        if len(moves) == 1:
+            # forced to win or block
+            priors = np.ones(1, dtype=np.float32)
+        else:
+            interest = self.move_interest_values[moves[:,0], moves[:,1]]
+            priors = interest / interest.sum()
+        return MCTSNode(moves, priors)
+
+    def run_batch(self, root, state, empty_spots_left, player):
+        """ Run a batch of playouts, evaluate the new leaves with one model call and back up their values """
+        pending = []
+        for _ in range(self.batch_size):
+            path, value = self.playout(root, state, empty_spots_left, player, len(pending))
+            if value is None:
+                pending.append(path)
+            else:
+                self.backup(path, value)
+        if len(pending) > 0:
+            values = self.model.predict(self.all_interest_states[:len(pending)]).ravel()
+            for path, value in zip(pending, values):
+                self.backup(path, float(value))
+        return self.batch_size
+
+    def playout(self, node, state, empty_spots_left, player, i_leaf):
+        """
+        Walk down the tree from node until a new move is reached, virtual loss is applied to the path
+        Return the path of (node, move index) and the value for the last mover if the game ended,
+        otherwise the new leaf is expanded, its dnn input is put in row i_leaf and the value is None
+        """
+        path = []
+        placed = []
+        value = None
+        while True:
+            i = node.select(self.c_puct)
+            # virtual loss, keeps the other playouts of this batch away from this path until backup
+            node.visits[i] += 1
+            node.value_sums[i] -= 1
+            path.append((node, i))
+            child = node.children[i]
+            if child is not None and not isinstance(child, MCTSNode):
+                value = child # the game ended with this move
+                break
+            r, c = node.moves[i]
+            state[r, c] = player
+            placed.append((r, c))
+            empty_spots_left -= 1
+            if child is None:
+                if i_win(state, (r, c), player):
+                    value = node.children[i] = 1.0
+                elif empty_spots_left == 0:
+                    value = node.children[i] = 0.0
+                else:
+                    node.children[i] = self.expand(state, empty_spots_left, -player)
+                    interest_state = self.all_interest_states[i_leaf]
+                    interest_state[0] = (state == player) # mover's stones, the dnn gives the value for the mover
+                    interest_state[1] = (state == -player)
+                    interest_state[2] = 1 if player == 1 else 0
+                break
+            node = child
+            player = -player
+        # recover state
+        for r, c in placed:
+            state[r, c] = 0
+        return path, value
+
+    def backup(self, path, value):
+        """ Add value (for the last mover of path) to the path with alternating sign, and remove the virtual loss """
+        for node, i in reversed(path):
+            node.value_sums[i] += 1 + value
+            value = -value
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+import time
+import numpy as np
+
+from gomoku_ai.ai_player import (board_size, find_interesting_moves, i_win, zobrist_hashes, update_hashes,
+                                 zobrist_table, canonical_key, BOUND_EXACT)
+from gomoku_ai.threat_space import find_vcf, VCF_MAX_DEPTH, VCF_LEAF_MAX_NODES
+
+PN_MAX_EMPTY_SPOTS = 30 # positions with at most this many empty spots are late enough to try solving
+PN_MAX_NODES = 30000 # nodes in the proof tree of each solve (bounds time and memory, ~1s), the solver gives up after that
+PN_MAX_TIME = 0.2 # seconds a solve may take before a search of fixed level, the solver gives up after that
+PN_TIME_SHARE = 0.1 # share of the time limit of a prediction a solve may take
+INF = 10**9
+
+class PNNode:
+    """ A node of the proof tree, is_or when the attacker is to move """
+    __slots__ = ('is_or', 'pn', 'dn', 'moves', 'children')
+
+    def __init__(self, is_or, pn=1, dn=1):
+        self.is_or = is_or
+        self.pn = pn # proof number, how many leaves must be proven to prove the attacker wins
+        self.dn = dn # disproof number, how many leaves must be disproven to show the attacker can not win
+        self.moves = None
+        self.children = None
+
+    def update(self):
+        """ Recompute proof and disproof numbers from the children """
+        if self.is_or:
+            self.pn = min(child.pn for child in self.children)
+            self.dn = min(sum(child.dn for child in self.children), INF)
+        else:
+            self.pn = min(sum(child.pn for child in self.children), INF)
+            self.dn = min(child.dn for child in self.children)
+
+class ProofNumberSolver:
+    """
+    Proof-number search that tries to solve a position as win, loss or draw for the player to move
+    All replies are searched, a win by 5 in a row or continuous fours (find_vcf) ends a branch
+    The nodes proven won are written to the cache as exact values, they are kept when the model changes
+    """
+
+    def __init__(self, cache, n_symmetries, level, max_nodes=PN_MAX_NODES, deadline=None):
+        self.cache = cache
+        self.n_symmetries = n_symmetries
+        self.level = level # cache level of the proven values, should be as deep as any search goes
+        self.max_nodes = max_nodes
+        self.deadline = deadline # wall clock time when the solver gives up, like the node budget
+        self.move_interest_values = np.zeros(board_size**2, dtype=np.float32).reshape(board_size,board_size)
+
+    def solve(self, state, empty_spots_left, player):
+        """ Return 1.0 if player (to move) wins, -1.0 if player loses, 0.0 for a draw, None if not solved within the budget """
+        # can player force a win
+        if self.prove(state, empty_spots_left, player, player):
+            result = 1.0
+        # if not, can the opponent force a win
+        elif self.proven is False and self.prove(state, empty_spots_left, player, -player):
+            result = -1.0
+        elif self.proven is False:
+            # neither side can force a win
+            result = 0.0
+        else:
+            return None
+        # the state was reached by the opponent's move, cache its value for the opponent
+        key = canonical_key(zobrist_hashes(state), self.n_symmetries)
+        self.cache.set(key, -result, self.level, BOUND_EXACT, proven=True)
+        return result
+
+    def prove(self, state, empty_spots_left, player, attacker):
+        """
+        Run the proof-number search from state with player to move, return True if attacker was proven to win
+        self.proven is True if proven, False if disproven and None if the node budget or the time ran out
+        """
+        self.n_nodes = 1
+        root = PNNode(player == attacker)
+        while root.pn != 0 and root.dn != 0 and self.n_nodes < self.max_nodes:
+            if self.deadline is not None and time.time() > self.deadline:
+                break
+            # walk down to the most proving node, placing the stones on the board
+            node = root
+            to_move = player
+            empty = empty_spots_left
+            path = [root]
+            placed = []
+            while node.children is not None:
+                if node.is_or:
+                    i = min(range(len(node.children)), key=lambda j: node.children[j].pn)
+                else:
+                    i = min(range(len(node.children)), key=lambda j: node.children[j].dn)
+                r, c = node.moves[i]
+                state[r, c] = to_move
+                placed.append((r, c))
+                node = node.children[i]
+                path.append(node)
+                to_move = -to_move
+                empty -= 1
+            self.expand(node, state, empty, to_move, attacker)
+            for node in reversed(path):
+                node.update()
+            # recover state
+            for r, c in placed:
+                state[r, c] = 0
+        self.proven = True if root.pn == 0 else False if root.dn == 0 else None
+        if self.proven:
+            self.share_proof(root, state, zobrist_hashes(state), player, attacker)
+        return self.proven is True
+
+    def expand(self, node, state, empty_spots_left, to_move, attacker):
+        """ Create the children of node, the ends of the game are proven or disproven right away """
+        self.move_interest_values.fill(0)
+        # all empty spots in order of interest, or the single move when there is a forced win or block
+        moves = find_interesting_moves(state, empty_spots_left, self.move_interest_values, to_move, empty_spots_left, False)
+        node.moves = moves
+        node.children = []
+        for r, c in moves:
+            state[r, c] = to_move
+            child = PNNode(-to_move == attacker)
+            winner = None
+            if i_win(state, (r, c), to_move):
+                winner = to_move
+            elif empty_spots_left == 1:
+                winner = 0 # draw
+            else:
+                vcf_r, _ = find_vcf(state, -to_move, VCF_MAX_DEPTH, VCF_LEAF_MAX_NODES)
+                if vcf_r >= 0:
+                    winner = -to_move
+            if winner == attacker:
+                child.pn, child.dn = 0, INF
+            elif winner is not None:
+                child.pn, child.dn = INF, 0
+            state[r, c] = 0
+            node.children.append(child)
+        self.n_nodes += len(moves)
+
+    def share_proof(self, node, state, hashes, to_move, attacker):
+        """ Write the proven children of node to the cache as exact values for their mover, and go down the proof """
+        value = 1.0 if to_move == attacker else -1.0
+        for (r, c), child in zip(node.moves, node.children):
+            if child.pn != 0:
+                continue
+            child_hashes = update_hashes(hashes, r, c, to_move, zobrist_table)
+            self.cache.set(canonical_key(child_hashes, self.n_symmetries), value, self.level, BOUND_EXACT, proven=True)
+            if child.children is not None:
+                state[r, c] = to_move
+                self.share_proof(child, state, child_hashes, -to_move, attacker)
+                state[r, c] = 0
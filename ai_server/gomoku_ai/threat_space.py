@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+# threat space search, proves forced wins by continuous fours (VCF)
+# a five is exactly 5 in a row like i_win, overlines do not count
+
+import numba
+import numpy as np
+
+board_size = 15
+VCF_MAX_DEPTH = 12 # most fours the attacker can play in a row
+VCF_MAX_NODES = 1000 # positions searched per call, the search gives up without a proof after that
+VCF_LEAF_MAX_NODES = 100 # smaller budget for the checks of each leaf move before the dnn evaluation
+DIRECTIONS = ((1,1), (1,0), (0,1), (1,-1))
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def makes_five(state, r, c, player):
+    """ Return true if a stone of player at the empty spot (r, c) makes exactly 5 in a row """
+    for dr, dc in DIRECTIONS:
+        line_length = 1
+        ext_r = r + dr
+        ext_c = c + dc
+        while 0 <= ext_r < board_size and 0 <= ext_c < board_size and state[ext_r, ext_c] == player:
+            line_length += 1
+            ext_r += dr
+            ext_c += dc
+        ext_r = r - dr
+        ext_c = c - dc
+        while 0 <= ext_r < board_size and 0 <= ext_c < board_size and state[ext_r, ext_c] == player:
+            line_length += 1
+            ext_r -= dr
+            ext_c -= dc
+        if line_length == 5:
+            return True
+    return False
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def five_points(state, player, out):
+    """ Find the empty spots where player makes 5, write them to out (n x 2) and return how many were found """
+    n = 0
+    for r in range(board_size):
+        for c in range(board_size):
+            if state[r, c] == 0 and makes_five(state, r, c, player):
+                out[n, 0] = r
+                out[n, 1] = c
+                n += 1
+    return n
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def five_points_through(state, r, c, player, out):
+    """
+    Same as five_points but only looks at the spots on the 4 lines through (r, c) within distance 4,
+    enough to find the new five points after a stone was placed at (r, c)
+    """
+    n = 0
+    for dr, dc in DIRECTIONS:
+        for d in range(-4, 5):
+            pr = r + d * dr
+            pc = c + d * dc
+            if d == 0 or pr < 0 or pr >= board_size or pc < 0 or pc >= board_size or state[pr, pc] != 0:
+                continue
+            if makes_five(state, pr, pc, player):
+                # the same spot can be found from two lines
+                new = True
+                for i in range(n):
+                    if out[i, 0] == pr and out[i, 1] == pc:
+                        new = False
+                if new:
+                    out[n, 0] = pr
+                    out[n, 1] = pc
+                    n += 1
+    return n
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def four_moves(state, player, forced_r, forced_c, out):
+    """
+    Find the moves of player that may make a four: the empty spots of 5-spot windows with 3 stones of player,
+    2 empty spots and no opponent stone. If forced_r >= 0 only the move at (forced_r, forced_c) is accepted
+    Write them to out (n x 2) without duplicates and return how many were found
+    """
+    seen = np.zeros((board_size, board_size), dtype=np.bool_)
+    n = 0
+    for dr, dc in DIRECTIONS:
+        for r in range(board_size):
+            for c in range(board_size):
+                end_r = r + 4 * dr
+                end_c = c + 4 * dc
+                if end_r < 0 or end_r >= board_size or end_c < 0 or end_c >= board_size:
+                    continue
+                n_mine = 0
+                n_empty = 0
+                for i in range(5):
+                    stone = state[r + i * dr, c + i * dc]
+                    if stone == player:
+                        n_mine += 1
+                    elif stone == 0:
+                        n_empty += 1
+                if n_mine != 3 or n_empty != 2:
+                    continue
+                for i in range(5):
+                    er = r + i * dr
+                    ec = c + i * dc
+                    if state[er, ec] != 0 or seen[er, ec]:
+                        continue
+                    if forced_r >= 0 and (er != forced_r or ec != forced_c):
+                        continue
+                    seen[er, ec] = True
+                    out[n, 0] = er
+                    out[n, 1] = ec
+                    n += 1
+    return n
+
+@numba.jit(nopython=True, nogil=True) # no cache, reloading the cached recursion crashes numba
+def vcf_search(state, player, forced_r, forced_c, depth, budget):
+    """
+    Return the first move of a continuous four win of player (to move), or (-1, -1) if none was found
+    Assumes player has no five point and the opponent has none, except the one at (forced_r, forced_c)
+    that player has to block if forced_r >= 0. budget[0] counts down the searched positions
+    """
+    budget[0] -= 1
+    if depth <= 0 or budget[0] < 0:
+        return -1, -1
+    moves = np.empty((board_size**2, 2), dtype=np.int64)
+    n_moves = four_moves(state, player, forced_r, forced_c, moves)
+    points = np.empty((4 * 8, 2), dtype=np.int64)
+    for i in range(n_moves):
+        r = moves[i, 0]
+        c = moves[i, 1]
+        state[r, c] = player
+        n_fives = five_points_through(state, r, c, player, points)
+        win = False
+        if n_fives >= 2:
+            # open four or double four, only one can be blocked
+            win = True
+        elif n_fives == 1:
+            # the opponent has to block, unless that makes 5 for the opponent
+            br = points[0, 0]
+            bc = points[0, 1]
+            if not makes_five(state, br, bc, -player):
+                state[br, bc] = -player
+                # the block may make a four for the opponent, which player has to block next
+                n_counter = five_points_through(state, br, bc, -player, points)
+                if n_counter == 0:
+                    win = vcf_search(state, player, -1, -1, depth-1, budget)[0] >= 0
+                elif n_counter == 1:
+                    win = vcf_search(state, player, points[0, 0], points[0, 1], depth-1, budget)[0] >= 0
+                state[br, bc] = 0
+        state[r, c] = 0
+        if win:
+            return r, c
+    return -1, -1
+
+@numba.jit(nopython=True, nogil=True)
+def find_vcf(state, player, max_depth=VCF_MAX_DEPTH, max_nodes=VCF_MAX_NODES):
+    """
+    Look for a forced win of player (to move) by 5 in a row or continuous fours
+    Return the winning move as (r, c), or (-1, -1) if no win was proven within max_depth fours and max_nodes positions
+    """
+    points = np.empty((board_size**2, 2), dtype=np.int64)
+    if five_points(state, player, points) > 0:
+        return points[0, 0], points[0, 1]
+    n_opponent_fives = five_points(state, -player, points)
+    if n_opponent_fives >= 2:
+        return -1, -1
+    forced_r = points[0, 0] if n_opponent_fives == 1 else -1
+    forced_c = points[0, 1] if n_opponent_fives == 1 else -1
+    budget = np.array([max_nodes], dtype=np.int64)
+    return vcf_search(state, player, forced_r, forced_c, max_depth, budget)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
-from server import app, socketio
 
 if __name__ == "__main__":
-    socketio.run(app, debug=False, use_reloader=False, port=5005, host="0.0.0.0")
\ No newline at end of file
+    # imported here so the spawned search workers do not start another server
+    from server import app, socketio
+    socketio.run(app, debug=False, use_reloader=False, port=5005, host="0.0.0.0")
@@ -1,4 +1,5 @@
 import os
+import hashlib
 from functools import wraps
 
 from server.server_namespace import server_ns
@@ -9,6 +10,41 @@ from ai_trainer.ai_trainer import AI_Trainer
 
 THIS_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
 DATA_ROOT_PATH = os.path.realpath(os.path.join(THIS_FOLDER_PATH, '../server_data'))
+# seconds per prediction, when set the AI searches deeper levels until the time is used up
+# instead of using the fixed aiLevel, a timeLimit in the web game state takes priority
+PREDICTION_TIME_LIMIT = None
+# when set, the root moves are searched side by side and their leaf positions are evaluated
+# by the model in batches of this size, which is much faster on gpu
+LEAF_BATCH_SIZE = None
+# search engine, 'minimax' or 'mcts', the web game can also ask for mcts with aiLevel = 'mcts'
+AI_ENGINE = 'minimax'
+# number of worker processes for level 2+ predictions, the root moves are split across them
+# e.g. os.cpu_count(), None searches in the server process
+SEARCH_WORKERS = None
+# name of a search cache in shared memory, the server processes on this host with the same name and model search with one table
+# (the search workers always share one), e.g. 'gomoku_cache'. The name is tagged with a hash of the model weights,
+# shared memory names are limited to 30 characters on macos
+SEARCH_SHARED_CACHE = None
+# selective search for high levels: the moves after this many at each node are searched one level shallower first
+# (late move reduction), and moves with interest below this ratio of the best move are skipped, e.g. 8 and 0.3
+SEARCH_REDUCE_LATE_MOVES = None
+SEARCH_WIDTH_RATIO = None
+# leaf moves that make a four are searched on with the forced block for up to this many plies instead of going to the dnn,
+# e.g. 2. Off by default, it costs more dnn positions than it saves
+SEARCH_QUIESCENCE_PLIES = None
+# memory budget of the search cache in bytes, the cache never grows past it, e.g. 2**30. None is 2M entries (32MB)
+SEARCH_CACHE_BYTES = None
+# keep the search cache in a file of server_data, one per model, so the positions searched before a restart
+# are known right away after it. The file is read lazily as the search touches it
+PERSISTENT_CACHE = False
+# keep searching the likely replies after each prediction while the player is thinking, the results are kept
+# in the cache for the next prediction. Stopped as soon as a new prediction is queued
+PONDER = False
+
+def file_hash(path):
+    """ Short content hash of a file """
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:16]
 
 # class method decorator to set the status to busy before executing the method
 def busy(method):
@@ -39,6 +75,7 @@ class ServerManager:
         self.ai_player = self.load_dnn_model_player()
         # queue for predictions
         self.prediction_queue = []
+        self.last_game_state = None # game state of the last prediction, for pondering
         # trainer to manage / monitor training process
         self.ai_trainer = AI_Trainer(self)
 
@@ -46,7 +83,14 @@ class ServerManager:
         model_file_path = os.path.join(self.root, 'dnn_model.pt')
         dnn_model = load_existing_model(model_file_path, no_training=True)
         print("Load dnn model successfully from ", model_file_path)
-        return AIPlayer("AI", model=dnn_model, level=1)
+        cache_file = None
+        if PERSISTENT_CACHE:
+            # the cached values only hold for this model, the file is tagged with its content
+            cache_file = os.path.join(self.root, f"search_cache_{file_hash(model_file_path)}.bin")
+            print("Using search cache file ", cache_file)
+        return AIPlayer("AI", model=dnn_model, level=1, time_limit=PREDICTION_TIME_LIMIT, leaf_batch_size=LEAF_BATCH_SIZE, engine=AI_ENGINE, n_workers=SEARCH_WORKERS,
+                        reduce_late_moves=SEARCH_REDUCE_LATE_MOVES, width_ratio=SEARCH_WIDTH_RATIO, quiescence_plies=SEARCH_QUIESCENCE_PLIES, shared_cache=SEARCH_SHARED_CACHE, cache_file=cache_file,
+                        cache_bytes=SEARCH_CACHE_BYTES)
 
     def getStatus(self):
         return self.status.value
@@ -57,6 +101,8 @@ class ServerManager:
         server_ns.post_status(status.value)
     
     def queue_prediction(self, game_state):
+        # the player has moved, stop searching the replies of the last prediction
+        self.ai_player.stop_pondering()
         self.prediction_queue.append(game_state)
 
     @busy
@@ -65,8 +111,14 @@ class ServerManager:
             print("process prediction called without any game_state in the queue")
             return {}
         game_state = self.prediction_queue.pop()
+        self.last_game_state = game_state
         return self.ai_player.predict(game_state)
 
+    def start_pondering(self, prediction_result):
+        """ Search the replies to the last prediction in the background while the player is thinking """
+        if PONDER and self.last_game_state is not None and self.status == ServerStatus.IDLE:
+            self.ai_player.start_pondering(self.last_game_state, prediction_result)
+
     def getMachineStats(self):
         return self.ai_trainer.get_machine_stats()
 
@@ -22,6 +22,7 @@ class ServerNameSpace(Namespace):
         prediction_result = self._manager.process_prediction()
         print("prediction result finished: ", prediction_result)
         self.emit("prediction", prediction_result)
+        self._manager.start_pondering(prediction_result)
 
     def on_getMachineStats(self):
         print("got event getMachineStats")
@@ -0,0 +1,48 @@
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gomoku_ai import ai_player
+
+# the board prints of predict are not needed here
+ai_player.show_state = lambda state: None
+
+class FakeModel:
+    """ Deterministic stand-in for the dnn model, counts its calls and evaluated positions """
+
+    def __init__(self, seed=0):
+        self.w = np.random.RandomState(seed).randn(3, 15, 15).astype(np.float32) * 0.3
+        self.calls = 0
+        self.n = 0
+
+    def predict(self, x):
+        self.calls += 1
+        self.n += len(x)
+        return np.tanh((x * self.w).sum(axis=(1, 2, 3)) * 0.2).reshape(-1, 1).astype(np.float32)
+
+def random_game(seed, n_stones):
+    """ Web game state with n_stones placed around the center """
+    rng = random.Random(seed)
+    history = []
+    taken = set()
+    while len(history) < n_stones:
+        r = min(14, max(0, int(rng.gauss(7, 2.5))))
+        c = min(14, max(0, int(rng.gauss(7, 2.5))))
+        if (r, c) in taken:
+            continue
+        taken.add((r, c))
+        history.append([r, c, 1 if len(history) % 2 == 0 else 2])
+    return {'playing': 1 if n_stones % 2 == 0 else 2, 'winner': 0, 'moveHistory': history, 'winningMoves': []}
+
+@pytest.fixture
+def model():
+    return FakeModel()
+
+@pytest.fixture
+def game():
+    return random_game(3, 10)
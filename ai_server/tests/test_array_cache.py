@@ -0,0 +1,156 @@
+import os
+import subprocess
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+from conftest import FakeModel
+from gomoku_ai import ai_player
+from gomoku_ai.ai_player import AIPlayer, ArrayCache, ARRAY_CACHE_SLOT_STEP, MappedArrayCache, SharedArrayCache, attach_shared_memory
+
+def bucket_keys(cache, bucket, n):
+    """ n keys that all fall in the same bucket of cache """
+    n_buckets = len(cache.datas) // 2
+    return [bucket + i * n_buckets for i in range(1, n+1)]
+
+def key_value(key):
+    """ A value that tells which key it was stored for, exact in float32 """
+    return (key % 4093) / 4096
+
+def test_torn_entry_is_rejected():
+    cache = ArrayCache(maxsize=ARRAY_CACHE_SLOT_STEP)
+    key_a, key_b = bucket_keys(cache, 5, 2)
+    cache.set(key_a, key_value(key_a), 3)
+    cache.set(key_b, key_value(key_b), 3)
+    slot_a = int(np.flatnonzero(cache.checks ^ cache.datas == key_a)[0])
+    slot_b = int(np.flatnonzero(cache.checks ^ cache.datas == key_b)[0])
+    # a write of b into the slot of a that was cut off after its data word, the check word is still the one of a
+    cache.datas[slot_a] = cache.datas[slot_b]
+    assert cache.get(key_a, 0) is None
+    assert cache.get(key_b, 0) == key_value(key_b)
+
+def test_concurrent_writes_never_return_values_of_other_keys():
+    # the kernels release the gil, so the writers and readers of one bucket really run at the same time
+    cache = ArrayCache(maxsize=ARRAY_CACHE_SLOT_STEP)
+    keys = bucket_keys(cache, 7, 16)
+    wrong = []
+    done = threading.Event()
+
+    def write(seed):
+        rng = np.random.RandomState(seed)
+        while not done.is_set():
+            key = keys[rng.randint(len(keys))]
+            cache.set(key, key_value(key), int(rng.randint(5)))
+
+    def read():
+        while not done.is_set():
+            for key in keys:
+                value = cache.get(key, 0)
+                if value is not None and value != key_value(key):
+                    wrong.append((key, value))
+
+    threads = [threading.Thread(target=write, args=(seed,)) for seed in range(3)] + [threading.Thread(target=read) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    done.wait(1.0)
+    done.set()
+    for thread in threads:
+        thread.join()
+    assert wrong == []
+    # the bucket holds two of the keys in the end, with their own values
+    found = [key for key in keys if cache.get(key, 0) is not None]
+    assert 0 < len(found) <= 2
+    assert all(cache.get(key, 0) == key_value(key) for key in found)
+
+def test_cache_fits_its_byte_budget():
+    max_bytes = 2**20
+    assert ArrayCache(max_bytes=max_bytes).nbytes <= max_bytes
+    with SharedArrayCache(max_bytes=max_bytes) as cache:
+        assert cache.nbytes <= max_bytes
+        assert cache.maxsize == max_bytes // 16 - ARRAY_CACHE_SLOT_STEP
+
+def test_shared_cache_follows_the_model():
+    name = f"test_cache_{os.getpid()}"
+    player = AIPlayer('AI', FakeModel(0), shared_cache=name, cache_bytes=2**20)
+    same_model = AIPlayer('AI 2', FakeModel(0), shared_cache=name, cache_bytes=2**20)
+    other_model = AIPlayer('AI 3', FakeModel(1), shared_cache=name, cache_bytes=2**20)
+    try:
+        assert same_model.cache.name == player.cache.name and not same_model.cache.owner
+        assert other_model.cache.name != player.cache.name and other_model.cache.owner
+        # a new model moves to its own block, the block of the old one is removed by its creator
+        old_name = player.cache.name
+        player.model = FakeModel(1)
+        player.reset_cache()
+        assert player.cache.name == other_model.cache.name
+        with pytest.raises(FileNotFoundError):
+            attach_shared_memory(old_name)
+    finally:
+        for p in (player, same_model, other_model):
+            p.close_cache()
+
+def test_players_sharing_a_cache_switch_its_model_once():
+    player = AIPlayer('AI', FakeModel(0))
+    other = AIPlayer('AI 2', player.model, cache=player.cache)
+    player.cache.set(5, 0.5, 1)
+    # same weights, the values are still good
+    player.reset_cache()
+    other.reset_cache()
+    assert player.cache.get(5, 0) == 0.5
+    player.model = other.model = FakeModel(1)
+    player.reset_cache()
+    other.reset_cache()
+    assert player.cache.model == 2
+    assert player.cache.get(5, 0) is None
+
+def test_shared_cache_is_removed_at_exit():
+    # the creator exits without closing the cache
+    name = f"test_exit_{os.getpid()}"
+    script = f"from gomoku_ai.ai_player import SharedArrayCache; cache = SharedArrayCache({name!r}, maxsize={ARRAY_CACHE_SLOT_STEP}); cache.set(5, 0.5, 1)"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', script], cwd=root, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert 'leaked' not in result.stderr
+    with pytest.raises(FileNotFoundError):
+        attach_shared_memory(name)
+
+def test_closed_shared_cache_can_be_closed_again():
+    with SharedArrayCache(maxsize=ARRAY_CACHE_SLOT_STEP) as cache:
+        cache.set(5, 0.5, 1)
+        assert cache.get(5, 0) == 0.5
+    name = cache.name
+    cache.close()
+    with pytest.raises(FileNotFoundError):
+        attach_shared_memory(name)
+
+def test_root_worker_warms_up_without_touching_the_shared_cache():
+    with SharedArrayCache(maxsize=ARRAY_CACHE_SLOT_STEP) as cache:
+        ai_player.init_root_worker(FakeModel(0), 8, cache_type=SharedArrayCache, cache_name=cache.name)
+        worker_cache = ai_player.root_worker_player.cache
+        try:
+            assert worker_cache.name == cache.name
+            assert cache.usage() == {}
+        finally:
+            worker_cache.close()
+            ai_player.root_worker_player = None
+
+def test_mapped_cache_is_written_on_close(tmp_path):
+    path = str(tmp_path / 'cache.bin')
+    cache = MappedArrayCache(path, maxsize=ARRAY_CACHE_SLOT_STEP, flush_interval=60)
+    cache.set(5, 0.5, 1)
+    thread = cache.flush_thread
+    cache.close()
+    assert not thread.is_alive()
+    cache.close()
+    with MappedArrayCache(path) as reopened:
+        assert reopened.maxsize == ARRAY_CACHE_SLOT_STEP
+        assert reopened.get(5, 0) == 0.5
+    assert os.listdir(tmp_path) == ['cache.bin']
+
+def test_short_cache_file_is_not_mapped(tmp_path):
+    path = str(tmp_path / 'cache.bin')
+    with open(path, 'wb') as f:
+        f.write(bytes(16))
+    with pytest.raises(ValueError):
+        MappedArrayCache(path)
@@ -0,0 +1,202 @@
+import time
+
+import numpy as np
+
+from conftest import FakeModel, random_game
+from gomoku_ai import ai_player, pn_search
+from gomoku_ai.bitboard import Bitboard
+from gomoku_ai.ai_player import AIPlayer, ArrayCache, InterestMap, SearchControl, canonical_move_keys, key_list, zobrist_hashes, zobrist_table
+
+def winrates(prediction):
+    return sorted(tuple(m) for m in prediction['moveWinrates'])
+
+def predict(player, game, level):
+    return player.predict(dict(game, aiLevel=level))
+
+def test_deeper_level_is_searched_after_shallower(model, game):
+    # the dnn values cached by level 1 are not values of level 1 searches
+    player = AIPlayer('AI', model)
+    level_1 = predict(player, game, 1)
+    calls = model.calls
+    level_2 = predict(player, game, 2)
+    assert model.calls > calls
+    fresh_level_2 = predict(AIPlayer('AI', FakeModel()), game, 2)
+    assert winrates(level_2) == winrates(fresh_level_2)
+    assert winrates(level_2) != winrates(level_1)
+
+def test_reduced_moves_are_stored_below_full_searches(model, game):
+    # a late move searched one level shallower is neither a dnn leaf value nor a full level value
+    player = AIPlayer('AI', model, reduce_late_moves=0)
+    server_state = player.server_game_state(game)
+    state = server_state['state']
+    hashes = zobrist_hashes(state)
+    empty = np.argwhere(state == 0)
+    root_keys = set(key_list(canonical_move_keys(hashes, empty, server_state['player'], player.n_symmetries, zobrist_table)))
+    stored = {}
+    cache_set = player.cache.set
+    def spy_set(key, value, level, *args, **kwargs):
+        if key in root_keys:
+            stored[key] = max(level, stored.get(key, level))
+        cache_set(key, value, level, *args, **kwargs)
+    player.cache.set = spy_set
+    # the moves failing low on the raised alpha are not searched again with the full level
+    player.best_action_q(state, server_state['empty_spots_left'], 0.0, 2.0, server_state['player'], 2)
+    reduced = [key for key, level in stored.items() if level == 1]
+    assert len(reduced) > 0
+    assert min(stored.values()) >= 1
+    for key in reduced:
+        assert player.cache.get(key, 1, 0.0, 2.0) is not None
+        assert player.cache.get(key, 2, 0.0, 2.0) is None
+
+class SaturatedModel(FakeModel):
+    """ A dnn that is sure of everything, its values are exactly 1.0 or -1.0 """
+
+    def predict(self, x):
+        return np.sign(super().predict(x) + 1e-6)
+
+def test_saturated_dnn_values_are_not_kept_for_new_models():
+    player = AIPlayer('AI', SaturatedModel())
+    predict(player, random_game(3, 8), 2)
+    assert len(player.cache.usage()) > 0
+    player.model = SaturatedModel(1)
+    player.reset_cache()
+    # only the values proven by the solvers would be kept, there are no threats in this game yet
+    assert player.cache.usage() == {}
+
+def test_proven_values_are_kept_for_new_models():
+    cache = ArrayCache(maxsize=1024)
+    cache.set(11, 1.0, 3)
+    cache.set(12, -1.0, 3, proven=True)
+    cache.new_model()
+    assert cache.get(11, 0) is None
+    assert cache.get_entry(12, 0) == (-1.0, True)
+
+def open_three_position():
+    """ White has an open three, black to move can not ignore it """
+    state = np.zeros((15, 15), dtype=np.int8)
+    for r, c in [(3, 3), (11, 11), (3, 11)]:
+        state[r, c] = 1
+    for r, c in [(7, 6), (7, 7), (7, 8)]:
+        state[r, c] = -1
+    return state
+
+def test_endgame_solve_is_bounded_and_not_repeated(monkeypatch):
+    state = open_three_position()
+    AIPlayer('AI', FakeModel()).solve_endgame(state, 219, 1, 1.0) # compile
+    player = AIPlayer('AI', FakeModel())
+    t_start = time.time()
+    player.solve_endgame(state, 219, 1, 1.0)
+    assert time.time() - t_start < 0.5
+    assert len(player.unsolved_positions) == 1
+    def solve(*args):
+        raise AssertionError("the position was not solved before, it should not be tried again")
+    monkeypatch.setattr(pn_search.ProofNumberSolver, 'solve', solve)
+    player.solve_endgame(state, 219, 1, 1.0)
+
+def test_helpers_follow_the_control_and_settings_of_their_player(model, monkeypatch):
+    player = AIPlayer('AI', model, leaf_batch_size=64, width_ratio=0.5)
+    def no_cache(*args, **kwargs):
+        raise AssertionError("a helper searches with the cache of its player")
+    monkeypatch.setattr(ai_player, 'ArrayCache', no_cache)
+    helper = player.search_helpers(1)[0]
+    assert helper.cache is player.cache
+    assert (helper.leaf_batch_size, helper.width_ratio) == (64, 0.5)
+    # a pondering helper stops its own helpers too, whatever they were doing when it was stopped
+    helper.control = SearchControl()
+    nested = helper.search_helpers(3)
+    helper.control.stop()
+    assert all(h.control.timed_out() for h in nested)
+    assert not player.control.timed_out()
+
+def test_stop_pondering_is_quick(model, game):
+    player = AIPlayer('AI', model, leaf_batch_size=64)
+    prediction = predict(player, game, 2)
+    player.start_pondering(dict(game, aiLevel=2), prediction)
+    time.sleep(0.2)
+    t_start = time.time()
+    player.stop_pondering()
+    assert time.time() - t_start < 0.2
+
+def test_move_ordering_is_reset_for_another_game(model, game):
+    player = AIPlayer('AI', model)
+    predict(player, game, 2)
+    # the game goes on, the move ordering of its last prediction is kept
+    history = player.history.copy()
+    next_game = random_game(3, 12)
+    assert next_game['moveHistory'][:10] == game['moveHistory']
+    predict(player, next_game, 2)
+    assert np.any(player.history != 0.5 * history)
+    assert np.all(player.history >= 0.5 * history)
+    # another game starts from the move ordering of a new player
+    other_game = random_game(4, 10)
+    predict(player, other_game, 2)
+    fresh_player = AIPlayer('AI', FakeModel())
+    predict(fresh_player, other_game, 2)
+    assert np.array_equal(player.history, fresh_player.history)
+
+def test_interest_map_follows_the_search(model, game, monkeypatch):
+    # the map is only moved with the search, at every position it has to match a map built from the whole board
+    n_checked = []
+    find_interesting_moves = InterestMap.find_interesting_moves
+    def checked_find_interesting_moves(self, state, *args):
+        assert np.array_equal(self.board, state)
+        fresh = InterestMap()
+        fresh.sync(state)
+        assert np.array_equal(self.values[:, state == 0], fresh.values[:, state == 0])
+        n_checked.append(1)
+        return find_interesting_moves(self, state, *args)
+    monkeypatch.setattr(InterestMap, 'find_interesting_moves', checked_find_interesting_moves)
+    predict(AIPlayer('AI', model), game, 2)
+    assert len(n_checked) > 100
+
+def test_bitboard_follows_the_search(model, game, monkeypatch):
+    # the stones are placed and removed on the bitboard with the search, at every position it has to match the whole board
+    n_checked = []
+    check_known = AIPlayer.check_known
+    def checked_check_known(self, state, *args):
+        fresh = Bitboard()
+        fresh.sync(state)
+        assert np.array_equal(self.bitboard.board, state)
+        assert np.array_equal(self.bitboard.lines, fresh.lines)
+        assert np.array_equal(self.bitboard.points, fresh.points)
+        assert np.array_equal(self.bitboard.n_points, fresh.n_points)
+        n_checked.append(1)
+        return check_known(self, state, *args)
+    monkeypatch.setattr(AIPlayer, 'check_known', checked_check_known)
+    predict(AIPlayer('AI', model), game, 2)
+    assert len(n_checked) > 100
+
+def test_quiescence_is_off_by_default_and_capped(model, monkeypatch):
+    extended = []
+    dnn_inputs = AIPlayer.dnn_inputs
+    def recorded_dnn_inputs(self, *args):
+        extended.append(self.extended_plies)
+        return dnn_inputs(self, *args)
+    monkeypatch.setattr(AIPlayer, 'dnn_inputs', recorded_dnn_inputs)
+    game = random_game(0, 12)
+    predict(AIPlayer('AI', model), game, 2)
+    assert set(extended) == {0}
+    extended.clear()
+    predict(AIPlayer('AI', model, quiescence_plies=2), game, 2)
+    assert max(extended) == 2
+
+def test_vcf_checks_run_once_per_leaf_position(model, monkeypatch):
+    n_calls = []
+    find_vcf = ai_player.find_vcf
+    def counted_find_vcf(*args):
+        n_calls.append(1)
+        return find_vcf(*args)
+    monkeypatch.setattr(ai_player, 'find_vcf', counted_find_vcf)
+    # a quiet game, the opponent has no forced win at the leaves
+    predict(AIPlayer('AI', model), random_game(3, 8), 2)
+    # the pre-pass and the opponent check run for each leaf position, not for each of its moves
+    assert 0 < len(n_calls) < model.n // 4
+
+def test_resumed_start_level_keeps_the_time_limit(model, game, monkeypatch):
+    player = AIPlayer('AI', model)
+    # an earlier prediction of level 7 would resume at level 5, far too deep for the time limit here
+    monkeypatch.setattr(player, 'resume_search', lambda *args: ([(7, 7)], 5))
+    t_start = time.time()
+    prediction = player.predict(dict(game, timeLimit=0.2))
+    assert time.time() - t_start < 0.5
+    assert player.level == 1 and len(prediction['moveWinrates']) > 0
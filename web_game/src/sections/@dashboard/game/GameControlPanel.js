@@ -246,6 +246,7 @@ export function AIControls({ serverState, gameSettings, handleUpdateSettings })
             <MenuItem value={1}>1</MenuItem>
             <MenuItem value={2}>2</MenuItem>
             <MenuItem value={3}>3</MenuItem>
+            <MenuItem value="mcts">MCTS</MenuItem>
           </Select>
         </FormControl>
       </ListItem>